@@ -0,0 +1,556 @@
+#!/usr/bin/env python
+
+"""benchmark.py
+
+Benchmark every ConferenceApi method and main.py handler against the App
+Engine testbed stubs, seeded with synthetic data.
+
+    python benchmark.py --sdk ~/google_appengine --conferences 200 \
+        --sessions 20 --out after.json --baseline before.json
+
+Token verification runs against TokenService, a local stand-in for
+the tokeninfo and signing key services.
+
+Each case is run --iterations times as a fresh request (new ConferenceApi
+instance, empty ndb context cache).  The report gives latency percentiles
+and, per call, the datastore RPCs, entities read and memcache RPCs as
+counted by stats.collect().  The stubs run in process, so latencies only
+mean something relative to another run on the same machine; RPC and
+entity counts are exact and comparable anywhere.  --out saves the
+results as JSON and --baseline prints the change against a saved run.
+A case that raises on any call is reported with its last error and
+makes the run exit with status 1.
+
+"""
+
+import argparse
+import base64
+import itertools
+import json
+import os
+import random
+import sys
+import time
+import urlparse
+from datetime import date
+from datetime import time as timeOfDay
+from datetime import timedelta
+
+CITIES = ['London', 'Chicago', 'Tokyo', 'Paris', 'San Francisco', 'Toronto']
+TOPICS = ['Medical Innovations', 'Programming Languages', 'Web Technologies',
+          'Movie Making', 'Health and Nutrition']
+SESSION_TYPES = ['Lecture', 'Keynote', 'Workshop', 'Panel']
+START = date(2026, 1, 5)
+
+METRICS = [('dsRpcs', 'rpc.datastore_v3'), ('entities', 'entitiesRead'),
+           ('mcRpcs', 'rpc.memcache')]
+
+
+def setupPath(sdk):
+    """Make the App Engine SDK and this app importable."""
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+class TokenService(object):
+    """Local stand-in for the tokeninfo and signing key services.
+
+    Tokens starting with "valid" are accepted; every other token, such
+    as an ID token with a made-up key id, is rejected.  The signing key
+    set is empty.  fetches counts the requests per URL.
+    """
+
+    def __init__(self, settings):
+        self.urls = {settings.TOKENINFO_URL: self.tokenInfo,
+                     settings.SIGNING_KEYS_URL: self.signingKeys}
+        self.fetches = dict((url, 0) for url in self.urls)
+
+    def matches(self, url):
+        return url.split('?')[0] in self.urls
+
+    def fetch(self, url, payload, method, headers, request, response,
+              **kwargs):
+        base = url.split('?')[0]
+        self.fetches[base] += 1
+        query = dict(urlparse.parse_qsl(urlparse.urlsplit(url).query))
+        status, content = self.urls[base](query)
+        response.set_statuscode(status)
+        response.set_content(json.dumps(content))
+        header = response.add_header()
+        header.set_key('Cache-Control')
+        header.set_value('public, max-age=3600')
+
+    def tokenInfo(self, query):
+        token = query.get('id_token') or query.get('access_token', '')
+        if not token.startswith('valid'):
+            return 400, {'error_description': 'invalid_token'}
+        return 200, {'user_id': token, 'email': '%s@example.com' % token,
+                     'expires_in': 3600}
+
+    def signingKeys(self, query):
+        return 200, {'keys': []}
+
+
+def setupTestbed(tokenService=None):
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    tb = testbed.Testbed()
+    # endpoints reads the app revision from the part after the dot
+    tb.setup_env(current_version_id='benchmark.1', overwrite=True)
+    tb.activate()
+    tb.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.
+            PseudoRandomHRConsistencyPolicy(probability=1))
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub(
+        root_path=os.path.dirname(os.path.abspath(__file__)))
+    tb.init_urlfetch_stub(urlmatchers=tokenService and
+                          [(tokenService.matches, tokenService.fetch)])
+    tb.init_mail_stub()
+    tb.init_user_stub()
+    tb.init_app_identity_stub()
+    return tb
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Benchmark(object):
+    """Seeded data set plus the cases run against it."""
+
+    def __init__(self, args, tokenService):
+        self.args = args
+        self.tokenService = tokenService
+        self.counter = itertools.count()
+
+    def userEmail(self, i):
+        return 'user%d@example.com' % i
+
+    def seed(self):
+        """Write the synthetic data set with put_multi, bypassing the API."""
+        from google.appengine.ext import ndb
+        from models import Conference, Profile, Registration, Session
+        from models import Speaker, Wishlist
+        args = self.args
+        rnd = random.Random(args.seed)
+
+        profiles = [Profile(key=ndb.Key(Profile, self.userEmail(i)),
+                            displayName='User %d' % i,
+                            mainEmail=self.userEmail(i))
+                    for i in range(args.profiles)]
+        speakers = [Speaker(name='Speaker %d' % i,
+                            email='speaker%d@example.com' % i)
+                    for i in range(args.speakers)]
+        ndb.put_multi(profiles + speakers)
+
+        conferences = []
+        for i in range(args.conferences):
+            # the benchmark user organises the first conference
+            organiser = profiles[0 if i == 0 else rnd.randrange(len(profiles))]
+            startDate = START + timedelta(days=rnd.randrange(365))
+            seats = rnd.choice([50, 100, 500])
+            conferences.append(Conference(parent=organiser.key,
+                name='Conference %d' % i,
+                description='Synthetic conference %d' % i,
+                organizerUserId=organiser.key.id(),
+                organizerDisplayName=organiser.displayName,
+                topics=rnd.sample(TOPICS, 2),
+                city=rnd.choice(CITIES),
+                startDate=startDate,
+                month=startDate.month,
+                endDate=startDate + timedelta(days=2),
+                maxAttendees=seats,
+                seatsAvailable=seats))
+        ndb.put_multi(conferences)
+
+        sessions = []
+        for conf in conferences:
+            for i in range(args.sessions):
+                sessions.append(Session(parent=conf.key,
+                    name='%s session %d' % (conf.name, i),
+                    websafeSpeakerKey=rnd.choice(speakers).key.urlsafe(),
+                    duration=rnd.choice([30, 60, 90, 120]),
+                    typeOfSession=rnd.choice(SESSION_TYPES),
+                    date=conf.startDate + timedelta(days=rnd.randrange(3)),
+                    startTime=timeOfDay(9 + rnd.randrange(12))))
+        ndb.put_multi(sessions)
+
+        others = []
+        for prof in profiles:
+            for sess in rnd.sample(sessions, min(args.wishlists, len(sessions))):
+                others.append(Wishlist(key=Wishlist.keyFor(prof.key, sess.key),
+                                       websafeSessionKey=sess.key.urlsafe(),
+                                       sessionName=sess.name,
+                                       userId=prof.key.id(),
+                                       duration=sess.duration))
+            for conf in rnd.sample(conferences,
+                                   min(args.registrations, len(conferences))):
+                others.append(Registration(
+                    key=Registration.keyFor(prof.key, conf.key),
+                    conferenceKey=conf.key))
+        ndb.put_multi(others)
+
+        self.profiles = profiles
+        self.speakers = speakers
+        self.conferences = conferences
+        self.sessions = sessions
+
+    def apiCases(self):
+        """(name, callable) for each ConferenceApi method."""
+        from protorpc import message_types
+        import conference as c
+        from models import ConferenceForm, ConferenceQueryForm
+        from models import ConferenceQueryForms, ProfileMiniForm, SessionForm
+        from models import SessionForms, SessionQueryForm, SessionQueryForms
+        from models import SpeakerForm, WishlistBatchForm
+
+        api = c.ConferenceApi
+        void = message_types.VoidMessage
+        conf = self.conferences[0]
+        wsck = conf.key.urlsafe()
+        other = self.conferences[-1].key.urlsafe()
+        sess = [s.key.urlsafe() for s in self.sessions[:10]]
+        wssk = self.speakers[0].key.urlsafe()
+        day = conf.startDate.isoformat()
+        n = self.counter.next
+
+        def request(container, **fields):
+            return container.combined_message_class(**fields)
+
+        def newSession():
+            return SessionForm(name='Bench session %d' % n(),
+                confWebsafeKey=wsck, websafeSpeakerKey=wssk, duration=60,
+                typeOfSession='Lecture', date=day, startTime='10:00')
+
+        return [
+            ('getProfile', lambda: api().getProfile(
+                request(c.VERSION_GET_REQUEST))),
+            ('saveProfile', lambda: api().saveProfile(
+                ProfileMiniForm(displayName='User 0'))),
+            ('createConference', lambda: api().createConference(
+                ConferenceForm(name='Bench conference %d' % n(),
+                               city='London', topics=TOPICS[:1],
+                               startDate=day, maxAttendees=100))),
+            ('updateConference', lambda: api().updateConference(
+                request(c.CONF_POST_REQUEST, websafeConferenceKey=wsck,
+                        description='Updated %d' % n()))),
+            ('getConference', lambda: api().getConference(
+                request(c.CONF_VERSION_GET_REQUEST, websafeConferenceKey=other))),
+            ('getConferencesCreated',
+                lambda: api().getConferencesCreated(void())),
+            ('queryConferences', lambda: api().queryConferences(
+                ConferenceQueryForms())),
+            ('queryConferences[city,month]', lambda: api().queryConferences(
+                ConferenceQueryForms(filters=[
+                    ConferenceQueryForm(field='CITY', operator='EQ',
+                                        value='London'),
+                    ConferenceQueryForm(field='MONTH', operator='GT',
+                                        value='6')]))),
+            ('queryConferences[city,month!=,paged]',
+                lambda: api().queryConferences(ConferenceQueryForms(
+                    pageSize=2, filters=[
+                        ConferenceQueryForm(field='CITY', operator='EQ',
+                                            value='London'),
+                        ConferenceQueryForm(field='MONTH', operator='NE',
+                                            value='6')]))),
+            ('registerForConference', lambda: api().registerForConference(
+                request(c.CONF_GET_REQUEST, websafeConferenceKey=other))),
+            ('unregisterFromConference',
+                lambda: api().unregisterFromConference(
+                    request(c.CONF_GET_REQUEST, websafeConferenceKey=other))),
+            ('getConferencesToAttend',
+                lambda: api().getConferencesToAttend(void())),
+            ('getConferenceAttendees', lambda: api().getConferenceAttendees(
+                request(c.CONF_ATTENDEES_GET_REQUEST,
+                        websafeConferenceKey=wsck))),
+            ('getAnnouncement', lambda: api().getAnnouncement(
+                request(c.VERSION_GET_REQUEST))),
+            ('createSession', lambda: api().createSession(newSession())),
+            ('createSessions[10]', lambda: api().createSessions(
+                SessionForms(items=[newSession() for i in range(10)]))),
+            ('getConferenceSessions', lambda: api().getConferenceSessions(
+                request(c.SESSIONS_GET_REQUEST, websafeConferenceKey=wsck))),
+            ('getConferenceSessionsByType',
+                lambda: api().getConferenceSessionsByType(
+                    request(c.SESSION_TYPE_GET_REQUEST,
+                            websafeConferenceKey=wsck,
+                            typeOfSession='Workshop'))),
+            ('getSessionsBySpeaker', lambda: api().getSessionsBySpeaker(
+                request(c.SESSION_SPEAKER_GET_REQUEST,
+                        websafeSpeakerKey=wssk))),
+            ('getSessionsGreaterThanDate',
+                lambda: api().getSessionsGreaterThanDate(
+                    request(c.SESSION_DATE_GET_REQUEST, date=day))),
+            ('getSessionsInDateRange[week]',
+                lambda: api().getSessionsInDateRange(
+                    request(c.SESSION_DATE_RANGE_GET_REQUEST, week=day))),
+            ('getSessionsNoWorkshopBefore7',
+                lambda: api().getSessionsNoWorkshopBefore7(
+                    request(c.SESSION_FIELDS_GET_REQUEST))),
+            ('querySessions', lambda: api().querySessions(
+                SessionQueryForms(websafeConferenceKey=wsck, filters=[
+                    SessionQueryForm(field='DURATION', operator='GTEQ',
+                                     value='60'),
+                    SessionQueryForm(field='TYPE', operator='NE',
+                                     value='Keynote')]))),
+            ('querySessions[date,startTime]', lambda: api().querySessions(
+                SessionQueryForms(websafeConferenceKey=wsck, filters=[
+                    SessionQueryForm(field='DATE', operator='EQ', value=day),
+                    SessionQueryForm(field='START_TIME', operator='GTEQ',
+                                     value='10:00')]))),
+            ('addSessionToWishlist', lambda: api().addSessionToWishlist(
+                request(c.WISHLIST_GET_REQUEST, websafeSessionKey=sess[0]))),
+            ('deleteSessionInWishlist', lambda: api().deleteSessionToWishlist(
+                request(c.WISHLIST_GET_REQUEST, websafeSessionKey=sess[0]))),
+            ('updateWishlist', lambda: api().updateWishlist(
+                WishlistBatchForm(add=sess[1:6], remove=sess[6:10]))),
+            ('getSessionsInWishlist',
+                lambda: api().getSessionsInWishlist(void())),
+            ('getWishlistSessionsLongerThanDuration',
+                lambda: api().getWishlistSessionsLongerThanDuration(
+                    request(c.WISHLIST_DURATION_GET_REQUEST, duration=60))),
+            ('createSpeaker', lambda: api().createSpeaker(
+                SpeakerForm(name='Bench Speaker %d' % n(),
+                            email='bench@example.com'))),
+            ('updateSpeaker', lambda: api().updateSpeaker(
+                request(c.SPEAKER_POST_REQUEST, websafeSpeakerKey=wssk,
+                        email='speaker0+%d@example.com' % n()))),
+            ('getSpeakers', lambda: api().getSpeakers(
+                request(c.SPEAKERS_GET_REQUEST))),
+            ('getSpeakers[prefix]', lambda: api().getSpeakers(
+                request(c.SPEAKERS_GET_REQUEST, prefix='speaker 1'))),
+            ('getFeaturedSpeaker', lambda: api().getFeaturedSpeaker(
+                request(c.CONF_VERSION_GET_REQUEST, websafeConferenceKey=wsck))),
+        ]
+
+    def handlerCases(self):
+        """(name, callable) for each main.py handler."""
+        import webapp2
+        import main
+
+        conf = self.conferences[0]
+
+        def call(path, method='POST', **params):
+            req = webapp2.Request.blank(path, POST=params or None)
+            req.method = method
+            resp = req.get_response(main.app)
+            if resp.status_int >= 500:
+                raise RuntimeError('%s returned %s' % (path, resp.status))
+
+        return [
+            ('/crons/set_announcement',
+                lambda: call('/crons/set_announcement', 'GET')),
+            ('/tasks/reconcile_nearly_sold_out',
+                lambda: call('/tasks/reconcile_nearly_sold_out')),
+            ('/tasks/send_confirmation_email',
+                lambda: call('/tasks/send_confirmation_email',
+                             email=self.userEmail(0),
+                             conferenceInfo=repr(conf))),
+            ('/tasks/rollup_seats',
+                lambda: call('/tasks/rollup_seats',
+                             conference_key=conf.key.urlsafe())),
+            ('/tasks/update_organizer_name',
+                lambda: call('/tasks/update_organizer_name',
+                             profile_key=self.profiles[0].key.urlsafe())),
+            ('/tasks/migrate_registrations',
+                lambda: call('/tasks/migrate_registrations')),
+            ('/tasks/migrate_wishlists',
+                lambda: call('/tasks/migrate_wishlists')),
+            ('/tasks/reindex_speakers',
+                lambda: call('/tasks/reindex_speakers')),
+            ('/tasks/reindex_sessions',
+                lambda: call('/tasks/reindex_sessions')),
+            ('/tasks/rebuild_speaker_sessions',
+                lambda: call('/tasks/rebuild_speaker_sessions')),
+            ('/tasks/update_speaker_name',
+                lambda: call('/tasks/update_speaker_name',
+                             speaker_key=self.speakers[0].key.urlsafe())),
+            ('/admin/stats', lambda: call('/admin/stats', 'GET')),
+        ]
+
+    def tokenCases(self):
+        """(name, callable) for utils.getUserId with OAuth tokens, verified
+        against the TokenService stand-in.
+        """
+        import settings
+        from utils import getUserId
+
+        n = self.counter.next
+
+        def b64(data):
+            return base64.urlsafe_b64encode(json.dumps(data)).rstrip('=')
+
+        def userId(token):
+            os.environ['HTTP_AUTHORIZATION'] = 'Bearer ' + token
+            try:
+                return getUserId(None, id_type='oauth')
+            finally:
+                del os.environ['HTTP_AUTHORIZATION']
+
+        def valid():
+            # a few tokens, so most calls hit the cache
+            token = 'valid-%d' % (n() % 5)
+            if userId(token) != token:
+                raise AssertionError('%s was not accepted' % token)
+
+        def invalid():
+            # a client retrying a few bad tokens, so most calls hit the
+            # negative cache
+            token = 'bad-%d' % (n() % 5)
+            if userId(token):
+                raise AssertionError('%s was accepted' % token)
+
+        def unknownKid():
+            token = '%s.%s.c2ln' % (
+                b64({'alg': 'RS256', 'kid': 'made-up-%d' % n()}),
+                b64({'iss': 'accounts.google.com', 'sub': 'x',
+                     'exp': time.time() + 3600}))
+            if userId(token):
+                raise AssertionError('a made-up key id was accepted')
+            # the first fetch and at most one refresh a minute
+            fetches = self.tokenService.fetches[settings.SIGNING_KEYS_URL]
+            if fetches > 2 and not self.args.cold:
+                raise AssertionError('signing keys fetched %d times' %
+                                     fetches)
+
+        return [
+            ('getUserId[oauth]', valid),
+            ('getUserId[oauth,invalid]', invalid),
+            ('getUserId[oauth,unknown kid]', unknownKid),
+        ]
+
+    def run(self):
+        """Run every case, returning {name: result}."""
+        from google.appengine.api import memcache
+        from google.appengine.ext import ndb
+        import stats
+
+        # keep the middleware's own flushes out of the measurements
+        stats.FLUSH_SECS = float('inf')
+        os.environ['ENDPOINTS_AUTH_EMAIL'] = self.userEmail(0)
+        os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
+
+        cases = self.apiCases() + self.handlerCases() + self.tokenCases()
+        if self.args.only:
+            cases = [case for case in cases if self.args.only in case[0]]
+        samples = dict((name, []) for name, fn in cases)
+        for i in range(self.args.iterations):
+            for name, fn in cases:
+                if self.args.cold:
+                    memcache.flush_all()
+                ndb.get_context().clear_cache()
+                error = None
+                with stats.collect() as counts:
+                    start = time.time()
+                    try:
+                        fn()
+                    except Exception, e:
+                        error = e
+                    elapsed = (time.time() - start) * 1000
+                samples[name].append((elapsed, counts, error))
+
+        results = {}
+        for name, fn in cases:
+            runs = samples[name]
+            times = [run[0] for run in runs]
+            result = {'calls': len(runs),
+                      'errors': sum(1 for run in runs if run[2]),
+                      'p50': percentile(times, 50),
+                      'p90': percentile(times, 90),
+                      'p99': percentile(times, 99)}
+            for label, metric in METRICS:
+                result[label] = sum(run[1].get(metric, 0)
+                                    for run in runs) / float(len(runs))
+            errors = [run[2] for run in runs if run[2]]
+            if errors:
+                result['lastError'] = '%s: %s' % (type(errors[-1]).__name__,
+                                                  errors[-1])
+            results[name] = result
+        return results
+
+
+def report(results, baseline=None):
+    """Print results as a table, with changes against baseline if given."""
+    columns = ['p50', 'p90', 'p99'] + [label for label, metric in METRICS]
+    width = max(len(name) for name in results) + 2
+    print ('%-*s' % (width, 'case') +
+           ''.join('%12s' % column for column in columns) + '%8s' % 'errors')
+    for name in sorted(results):
+        result = results[name]
+        old = (baseline or {}).get(name)
+        cells = []
+        for column in columns:
+            cell = '%.2f' % result[column]
+            if old and column in old:
+                cell += '%+.0f%%' % (100.0 * (result[column] - old[column]) /
+                                     old[column] if old[column] else 0)
+            cells.append('%12s' % cell)
+        print '%-*s' % (width, name) + ''.join(cells) + \
+            '%8d' % result['errors']
+        if 'lastError' in result:
+            print '%*s%s' % (width, '', result['lastError'])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--profiles', type=int, default=50)
+    parser.add_argument('--conferences', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=10,
+                        help='sessions per conference')
+    parser.add_argument('--speakers', type=int, default=100)
+    parser.add_argument('--wishlists', type=int, default=10,
+                        help='wishlist entries per profile')
+    parser.add_argument('--registrations', type=int, default=5,
+                        help='registrations per profile')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--cold', action='store_true',
+                        help='flush memcache before every call')
+    parser.add_argument('--only', help='run only cases containing this')
+    parser.add_argument('--out', help='save results as JSON')
+    parser.add_argument('--baseline', help='compare with a saved run')
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+
+    setupPath(args.sdk)
+    import settings
+    tokenService = TokenService(settings)
+    tb = setupTestbed(tokenService)
+    try:
+        bench = Benchmark(args, tokenService)
+        bench.seed()
+        results = bench.run()
+    finally:
+        tb.deactivate()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+    if args.out:
+        params = dict((name, getattr(args, name)) for name in
+                      ('profiles', 'conferences', 'sessions', 'speakers',
+                       'wishlists', 'registrations', 'iterations', 'seed',
+                       'cold'))
+        with open(args.out, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=2,
+                      sort_keys=True)
+
+    failed = sorted(name for name in results if results[name]['errors'])
+    if failed:
+        print
+        print '%d cases failed: %s' % (len(failed), ', '.join(failed))
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
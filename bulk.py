@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+
+"""bulk.py
+
+Bulk import and export of Conferences, Sessions, Speakers and Wishlist
+entries as JSONL or CSV files in Cloud Storage.
+
+A job runs as a chain of tasks.  Each task works through fixed-size
+batches (one put_multi or one query page per batch) for up to
+TASK_BUDGET_SECS, checkpointing its BulkJob after every batch, then
+enqueues the next task.  Only one batch is held in memory at a time.
+
+Rows are the API's own forms (ConferenceForm, SessionForm, SpeakerForm,
+WishlistForm), so an export can be imported again as it is.  A row with
+a websafeKey keeps its key, and Wishlist entries are keyed by profile
+and session.  Other rows get keys allocated per batch, and the keys are
+stored in the checkpoint before the batch is written.  A retried batch
+therefore rewrites the same entities rather than duplicating them.
+
+An export writes one part file per batch, <path>-00000.jsonl and so on,
+because a Cloud Storage object can't be appended to across requests.
+
+CSV files have a header row, one record per row, and repeated fields
+separated by ';'.  A quoted field may span lines, so text with newlines
+survives an export and import.
+
+Imported rows go through the same bookkeeping as the API's writes: the
+query caches, the nearly sold out index, the featured speaker aggregates
+and the speaker names copied onto them.
+
+"""
+
+import csv
+import json
+import logging
+import time
+from cStringIO import StringIO
+from datetime import datetime
+
+from protorpc import messages
+from protorpc import protojson
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+try:
+    import cloudstorage as gcs
+except ImportError:
+    gcs = None
+
+from conference import ConferenceApi
+from conference import CONFERENCE_FORM_PLAN
+from conference import SESSION_FORM_PLAN
+from conference import SPEAKER_FORM_PLAN
+from conference import VERSION_FIELDS
+from conference import WISHLIST_FORM_PLAN
+from models import BulkJob
+from models import Conference
+from models import NearlySoldOut
+from models import Profile
+from models import Session
+from models import Speaker
+from models import Wishlist
+
+BATCH_SIZE = 500
+TASK_BUDGET_SECS = 60
+FORMATS = ('jsonl', 'csv')
+REPEATED_SEPARATOR = ';'
+
+
+# the forms carry a missing date or time as the string 'None'
+def _date(value):
+    if not value or value == 'None':
+        return None
+    return datetime.strptime(value[:10], "%Y-%m-%d").date()
+
+
+def _time(value):
+    if not value or value == 'None':
+        return None
+    return datetime.strptime(value[:5], "%H:%M").time()
+
+
+def _required(form, *names):
+    for name in names:
+        if not getattr(form, name):
+            raise ValueError("'%s' field required" % name)
+
+
+def _conferenceData(form):
+    _required(form, 'name', 'organizerUserId')
+    startDate = _date(form.startDate)
+    return dict(name=form.name, description=form.description,
+                organizerUserId=form.organizerUserId,
+                organizerDisplayName=form.organizerDisplayName,
+                topics=list(form.topics), city=form.city,
+                startDate=startDate, endDate=_date(form.endDate),
+                month=startDate.month if startDate else 0,
+                maxAttendees=form.maxAttendees or 0,
+                seatsAvailable=form.seatsAvailable
+                    if form.seatsAvailable is not None
+                    else form.maxAttendees or 0)
+
+
+def _sessionData(form):
+    _required(form, 'name', 'confWebsafeKey')
+    return dict(name=form.name, highlights=form.highlights,
+                websafeSpeakerKey=form.websafeSpeakerKey,
+                duration=form.duration, typeOfSession=form.typeOfSession,
+                date=_date(form.date), startTime=_time(form.startTime))
+
+
+def _speakerData(form):
+    _required(form, 'name', 'email')
+    return dict(name=form.name, email=form.email)
+
+
+def _wishlistData(form):
+    _required(form, 'userId', 'websafeSessionKey')
+    return dict(websafeSessionKey=form.websafeSessionKey,
+                sessionName=form.sessionName, userId=form.userId,
+                duration=form.duration)
+
+
+def _wishlistKey(form):
+    return Wishlist.keyFor(ndb.Key(Profile, form.userId),
+                           ndb.Key(urlsafe=form.websafeSessionKey))
+
+
+class _Kind(object):
+    """How one model is read from and written to bulk files."""
+
+    def __init__(self, model, plan, data, parent=None, key=None):
+        self.model = model
+        self.plan = plan
+        self.form = plan.message
+        self.data = data
+        self.parent = parent or (lambda form: None)
+        self.key = key
+
+
+KINDS = {
+    'conferences': _Kind(Conference, CONFERENCE_FORM_PLAN, _conferenceData,
+        parent=lambda form: ndb.Key(Profile, form.organizerUserId)),
+    'sessions': _Kind(Session, SESSION_FORM_PLAN, _sessionData,
+        parent=lambda form: ndb.Key(urlsafe=form.confWebsafeKey)),
+    'speakers': _Kind(Speaker, SPEAKER_FORM_PLAN, _speakerData),
+    'wishlists': _Kind(Wishlist, WISHLIST_FORM_PLAN, _wishlistData,
+        key=_wishlistKey),
+}
+
+
+# - - - file formats - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _decodeRow(form, columns, line):
+    """Parse one CSV line with the given header into a form."""
+    values = next(csv.reader([line]))
+    data = {}
+    for name, value in zip(columns, values):
+        field = form.field_by_name(name)
+        value = value.decode('utf-8')
+        if field.repeated:
+            value = [v for v in value.split(REPEATED_SEPARATOR) if v]
+        elif value == '':
+            continue
+        elif isinstance(field, messages.IntegerField):
+            value = int(value)
+        data[name] = value
+    return protojson.decode_message(form, json.dumps(data))
+
+
+def _columns(form):
+    return [field for field in form.all_fields()
+            if field.name not in VERSION_FIELDS]
+
+
+def _encodeRow(form, message):
+    """Return message as one CSV line in form's field order."""
+    values = []
+    for field in _columns(form):
+        value = getattr(message, field.name)
+        if field.repeated:
+            value = REPEATED_SEPARATOR.join(value)
+        elif value is None:
+            value = ''
+        values.append(unicode(value).encode('utf-8'))
+    out = StringIO()
+    csv.writer(out, lineterminator='\n').writerow(values)
+    return out.getvalue()
+
+
+def _header(form):
+    out = StringIO()
+    csv.writer(out, lineterminator='\n').writerow(
+        [field.name for field in _columns(form)])
+    return out.getvalue()
+
+
+# - - - batches - - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def _readLines(job):
+    """Read the next batch of lines from job.offset.
+
+    Returns (lines, end offset).  A CSV header is stored on the job and
+    job.offset moved past it.
+    """
+    f = gcs.open(job.path)
+    try:
+        f.seek(job.offset)
+        if job.format == 'csv' and not job.columns:
+            job.columns = next(csv.reader([f.readline()]), [])
+            job.offset = f.tell()
+        lines = []
+        while len(lines) < BATCH_SIZE:
+            line = f.readline()
+            if not line:
+                break
+            # an odd number of quotes leaves a quoted field open
+            while job.format == 'csv' and line.count('"') % 2:
+                rest = f.readline()
+                if not rest:
+                    break
+                line += rest
+            if line.strip():
+                lines.append(line)
+        return lines, f.tell()
+    finally:
+        f.close()
+
+
+def _batchKeys(job, kind, forms):
+    """Return a key for each form, allocating ids as needed.
+
+    Allocated keys are checkpointed before the batch is written, and a
+    retry of the same batch reuses them.
+    """
+    if job.pendingOffset == job.offset and len(job.pendingKeys) == len(forms):
+        return [ndb.Key(urlsafe=key) for key in job.pendingKeys]
+
+    keys = []
+    needed = {}
+    for i, form in enumerate(forms):
+        try:
+            if getattr(form, 'websafeKey', None):
+                keys.append(ndb.Key(urlsafe=form.websafeKey))
+            elif kind.key:
+                keys.append(kind.key(form))
+            else:
+                keys.append(None)
+                needed.setdefault(kind.parent(form), []).append(i)
+        except Exception, e:
+            # malformed websafe keys fail in several different ways
+            raise ValueError('bad key in row %d of the batch at byte %d: %s'
+                             % (i, job.offset, e))
+    for parent, indexes in needed.iteritems():
+        first, last = kind.model.allocate_ids(size=len(indexes), parent=parent)
+        for i, id_ in zip(indexes, range(first, last + 1)):
+            keys[i] = ndb.Key(kind.model, id_, parent=parent)
+
+    job.pendingOffset = job.offset
+    job.pendingKeys = [key.urlsafe() for key in keys]
+    job.put()
+    return keys
+
+
+def _importBatch(job, kind):
+    """Import the next batch; returns False once the file is done."""
+    lines, end = _readLines(job)
+    start = job.offset
+    retry = job.pendingOffset == job.offset
+    if not lines:
+        return False
+    forms = []
+    for line in lines:
+        try:
+            if job.format == 'csv':
+                forms.append(_decodeRow(kind.form, job.columns, line))
+            else:
+                forms.append(protojson.decode_message(kind.form, line))
+        except (ValueError, KeyError, messages.Error), e:
+            raise ValueError('bad row after byte %d: %s' % (start, e))
+
+    keys = _batchKeys(job, kind, forms)
+    entities = []
+    for key, form in zip(keys, forms):
+        try:
+            entities.append(kind.model(key=key, **kind.data(form)))
+        except (ValueError, TypeError), e:
+            raise ValueError('bad row after byte %d: %s' % (start, e))
+    existing = []
+    if kind.model is Speaker:
+        existing = ndb.get_multi(keys)
+    ndb.put_multi(entities)
+    _imported(kind, entities, existing, retry)
+
+    job.offset = end
+    job.count += len(entities)
+    job.pendingOffset = None
+    job.pendingKeys = []
+    return True
+
+
+def _imported(kind, entities, existing, retry):
+    """Do the bookkeeping the API does on writes for a written batch.
+
+    existing holds the Speakers the batch replaced.  A retried batch may
+    already have replaced them, so then every one counts as renamed.
+    """
+    keys = [entity.key for entity in entities]
+    if kind.model is Conference:
+        ConferenceApi._conferencesChanged(*keys)
+        listed = ndb.get_multi([ndb.Key(NearlySoldOut, key.urlsafe())
+                                for key in keys])
+        for conf, entry in zip(entities, listed):
+            if ConferenceApi._settleNearlySoldOut(conf, entry):
+                ConferenceApi._syncNearlySoldOutCache(conf.key.urlsafe())
+    elif kind.model is Session:
+        c_keys = set(key.parent() for key in keys)
+        ConferenceApi._sessionsChanged(*c_keys)
+        for c_key in c_keys:
+            ConferenceApi._rebuildConferenceSpeakers(c_key)
+    elif kind.model is Speaker:
+        tasks = [taskqueue.Task(params={'speaker_key': speaker.key.urlsafe()},
+                                url='/tasks/update_speaker_name')
+                 for speaker, old in zip(entities, existing)
+                 if old and (retry or old.name != speaker.name)]
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            taskqueue.Queue().add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+
+def _exportBatch(job, kind):
+    """Export the next page as one part file; returns False when done."""
+    entities, cursor, more = kind.model.query().fetch_page(BATCH_SIZE,
+        start_cursor=Cursor(urlsafe=job.cursor) if job.cursor else None)
+    if not entities:
+        # the previous page was the last one after all
+        return False
+    name = '%s-%05d.%s' % (job.path, job.part, job.format)
+    f = gcs.open(name, 'w', content_type='text/csv' if job.format == 'csv'
+                 else 'application/json')
+    try:
+        if job.format == 'csv':
+            f.write(_header(kind.form))
+        for message in kind.plan.copyAll(entities):
+            if job.format == 'csv':
+                f.write(_encodeRow(kind.form, message))
+            else:
+                f.write(protojson.encode_message(message) + '\n')
+    finally:
+        f.close()
+
+    job.part += 1
+    job.count += len(entities)
+    job.cursor = cursor.urlsafe() if more and cursor else None
+    return bool(job.cursor)
+
+
+# - - - task chain - - - - - - - - - - - - - - - - - - - - - - - - - -
+
+def start(operation, kind, path, format='jsonl'):
+    """Create a BulkJob and enqueue its first task; returns the job.
+
+    path is a Cloud Storage /bucket/object name; for an export it is the
+    prefix of the part files.
+    """
+    if gcs is None:
+        raise ValueError('the cloudstorage library is not available')
+    if operation not in ('import', 'export'):
+        raise ValueError('unknown operation: %s' % operation)
+    if kind not in KINDS:
+        raise ValueError('unknown kind: %s' % kind)
+    if format not in FORMATS:
+        raise ValueError('unknown format: %s' % format)
+    job = BulkJob(operation=operation, kind=kind, path=path, format=format)
+    job.put()
+    _enqueue(job)
+    return job
+
+
+def _enqueue(job):
+    # named per step, so a duplicate enqueue of a step is dropped
+    try:
+        taskqueue.add(url='/tasks/bulk',
+                      name='bulk-%d-%d' % (job.key.id(), job.step),
+                      params={'job': job.key.id(), 'step': job.step})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def run(job_id, step):
+    """Run one task of a job: batches until the budget is spent."""
+    job = BulkJob.get_by_id(job_id)
+    if not job or job.status != 'running' or job.step != step:
+        # finished, or a stale retry of a step already handed on
+        return
+    kind = KINDS[job.kind]
+    batch = _importBatch if job.operation == 'import' else _exportBatch
+    deadline = time.time() + TASK_BUDGET_SECS
+
+    try:
+        more = True
+        while more and time.time() < deadline:
+            more = batch(job, kind)
+            job.put()
+    except ValueError, e:
+        logging.warning('bulk job %d failed: %s', job_id, e)
+        job.status = 'failed'
+        job.error = unicode(e)
+        job.put()
+        return
+
+    if more:
+        job.step += 1
+        job.put()
+        _enqueue(job)
+        return
+
+    job.status = 'done'
+    job.put()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+"""cache.py
+
+Generation-versioned memcache entries.
+
+Each cached value is stored together with the generation of the thing it
+was built from.  Writers bump the generation after they commit instead of
+deleting cache entries, and a reader only trusts an entry whose
+generation is still current.  A reader that built its value from data
+read before a write can therefore never make that stale value visible:
+it stores it under the old generation, which no longer matches.
+
+"""
+
+import time
+
+from protorpc import protobuf
+
+from google.appengine.api import memcache
+
+MEMCACHE_GENERATION_KEY = 'GENERATION:%s'
+
+
+def _initialGeneration():
+    """Starting value for a (re)created generation counter.
+
+    Time based so that a counter evicted from memcache doesn't start
+    again at a value some old cache entry still carries.
+    """
+    return int(time.time() * 1000)
+
+
+def generationKey(name):
+    """Return the memcache key holding the generation for name."""
+    return MEMCACHE_GENERATION_KEY % name
+
+
+def _startGeneration(gen_key):
+    gen = _initialGeneration()
+    if not memcache.add(gen_key, gen):
+        gen = memcache.get(gen_key)
+    return gen
+
+
+def generation(name):
+    """Return the current generation for name, starting it if missing.
+
+    Also usable on its own as a version stamp for whatever name covers,
+    since it changes on every bump and a restarted counter starts from
+    the current time rather than from an old value.
+    """
+    gen_key = generationKey(name)
+    gen = memcache.get(gen_key)
+    if gen is None:
+        gen = _startGeneration(gen_key)
+    return gen
+
+
+def getCurrent(key, name):
+    """Return (value, generation) for cache entry key versioned by name.
+
+    value is None unless the entry exists and was stored at the current
+    generation; both lookups are a single memcache RPC.
+    """
+    gen_key = generationKey(name)
+    values = memcache.get_multi([key, gen_key])
+    gen = values.get(gen_key)
+    if gen is None:
+        return None, _startGeneration(gen_key)
+    entry = values.get(key)
+    if entry and entry[0] == gen:
+        return entry[1], gen
+    return None, gen
+
+
+def setCurrent(key, gen, value, ttl=0):
+    """Store value for key as built at generation gen."""
+    memcache.set(key, (gen, value), time=ttl)
+
+
+def bump(*names):
+    """Advance the generations for names, invalidating their entries."""
+    if names:
+        memcache.offset_multi(dict((generationKey(name), 1) for name in names),
+                              initial_value=_initialGeneration())
+
+
+def replace(key, name, value, ttl=0):
+    """Bump name and store value for key at the new generation.
+
+    For a writer that has just built the new value itself.  If another
+    bump gets in between, the entry is simply not current and the next
+    reader rebuilds it.
+    """
+    gen = memcache.incr(generationKey(name), initial_value=_initialGeneration())
+    if gen is not None:
+        setCurrent(key, gen, value, ttl=ttl)
+
+
+def getMessage(key, name, message_type):
+    """Like getCurrent, for a ProtoRPC message stored by setMessage."""
+    data, gen = getCurrent(key, name)
+    if data is None:
+        return None, gen
+    return protobuf.decode_message(message_type, data), gen
+
+
+def setMessage(key, gen, message, ttl=0):
+    """Like setCurrent, for a ProtoRPC message."""
+    setCurrent(key, gen, protobuf.encode_message(message), ttl=ttl)
@@ -14,6 +14,9 @@ updated by David D on 2016 jan 24
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 from datetime import datetime
+import functools
+import hashlib
+import logging
 
 import endpoints
 from protorpc import messages
@@ -22,12 +25,17 @@ from protorpc import remote
 
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
 from models import ConflictException
+from models import ContentionException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import ProfileForms
+from models import Registration
 from models import StringMessage
 from models import BooleanMessage
 from models import Conference
@@ -35,32 +43,57 @@ from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
+from models import NearlySoldOut
 from models import TeeShirtSize
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionQueryForm
+from models import SessionQueryForms
 from models import Wishlist
 from models import WishlistForm
+from models import WishlistBatchForm
 from models import WishlistForms
 from models import Speaker
 from models import SpeakerMiniForm
 from models import SpeakerForm
 from models import SpeakerForms
+from models import SpeakerSessions
+from models import normalizeName
+from models import weekOf
 
 from settings import WEB_CLIENT_ID
 from settings import ANDROID_CLIENT_ID
 from settings import IOS_CLIENT_ID
 from settings import ANDROID_AUDIENCE
 
-from utils import getUserId
+from context import RequestContext
+
+import cache
+import seats
+import serializers
+import stats
 
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
-MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+# websafe key -> name of the conferences in the NearlySoldOut index
+MEMCACHE_NEARLY_SOLD_OUT_KEY = "NEARLY_SOLD_OUT"
+# a conference with 1..NEARLY_SOLD_OUT_SEATS seats left is announced
+NEARLY_SOLD_OUT_SEATS = 5
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
-MEMCACHE_CONFERENCE_FEATURED_SPEAKERS_KEY = "CONFERENCE_FEATURED_SPEAKERS"
+MEMCACHE_CONFERENCE_KEY = "CONFERENCE:%s"
+MEMCACHE_CONFERENCE_QUERY_KEY = "CONFERENCE_QUERY:%s"
+# generation bumped by every conference write; versions cached query results
+CONFERENCES_GENERATION = "CONFERENCES"
+CONFERENCE_QUERY_CACHE_SECS = 10 * 60
+MEMCACHE_FEATURED_SPEAKER_KEY = "FEATURED_SPEAKER:%s"
+# generations bumped by writes; version getConferenceSessions and getProfile
+CONFERENCE_SESSIONS_GENERATION = "CONFERENCE_SESSIONS:%s"
+PROFILE_GENERATION = "PROFILE:%s"
+# conditional GET fields of the forms; never stored on an entity
+VERSION_FIELDS = ('version', 'notModified')
 FEATURED_SPEAKERS_TPL = ('Featured Speaker for conference: %s is %s! '
                          'Sessions include: %s')
 
@@ -82,6 +115,16 @@ OPERATORS = {
             'NE':   '!='
             }
 
+# page size used when the client does not supply one, and the upper bound
+# we allow a client to ask for in a single response
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+
+# upper bound on the number of sessions createSessions takes per call; a
+# conference's sessions and their speaker aggregates (at most one per
+# session) are committed together, and a commit takes 500 entities
+MAX_SESSIONS_PER_BATCH = 250
+
 FIELDS =    {
             'CITY': 'city',
             'TOPIC': 'topics',
@@ -89,27 +132,108 @@ FIELDS =    {
             'MAX_ATTENDEES': 'maxAttendees',
             }
 
+# session query field -> (Session property, value parser)
+SESSION_FIELDS = {
+            'TYPE': ('typeOfSession', unicode),
+            'SPEAKER': ('websafeSpeakerKey', unicode),
+            'DATE': ('date',
+                     lambda v: datetime.strptime(v[:10], "%Y-%m-%d").date()),
+            'START_TIME': ('startTime',
+                           lambda v: datetime.strptime(v[:5], "%H:%M").time()),
+            'DURATION': ('duration', int),
+            }
+
+# when several session properties have inequality filters, the one pushed
+# into the datastore is the first of these (after preferring a property
+# bounded on both sides); the rest are applied while streaming
+SESSION_INEQUALITY_PREFERENCE = ['date', 'startTime', 'duration',
+                                 'websafeSpeakerKey', 'typeOfSession']
+
+PREDICATES = {
+            '=':  lambda a, b: a == b,
+            '!=': lambda a, b: a != b,
+            '<':  lambda a, b: a is not None and a < b,
+            '<=': lambda a, b: a is not None and a <= b,
+            '>':  lambda a, b: a is not None and a > b,
+            '>=': lambda a, b: a is not None and a >= b,
+            }
+
+# a query page stops after reading this many times pageSize entities,
+# even if filtering in Python left the page short
+QUERY_SCAN_FACTOR = 10
+# the datastore runs at most this many queries for one IN filter
+MAX_IN_VALUES = 30
+
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
     websafeConferenceKey=messages.StringField(1),
 )
 
+CONF_VERSION_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    ifNoneMatch=messages.StringField(2),
+)
+
+VERSION_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    ifNoneMatch=messages.StringField(1),
+)
+
+CONF_ATTENDEES_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
 CONF_POST_REQUEST = endpoints.ResourceContainer(
     ConferenceForm,
     websafeConferenceKey=messages.StringField(1),
 )
 
+SESSIONS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+    ifNoneMatch=messages.StringField(3),
+)
+
 SESSION_TYPE_GET_REQUEST = endpoints.ResourceContainer(
     websafeConferenceKey=messages.StringField(1),
     typeOfSession=messages.StringField(2),
+    fields=messages.StringField(3, repeated=True),
 )
 
 SESSION_SPEAKER_GET_REQUEST = endpoints.ResourceContainer(
     speaker=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+    websafeSpeakerKey=messages.StringField(3),
+    pageSize=messages.IntegerField(4, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(5),
 )
 
 SESSION_DATE_GET_REQUEST = endpoints.ResourceContainer(
     date=messages.StringField(1),
+    fields=messages.StringField(2, repeated=True),
+    pageSize=messages.IntegerField(3, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(4),
+)
+
+SESSION_DATE_RANGE_GET_REQUEST = endpoints.ResourceContainer(
+    fromDate=messages.StringField(1),
+    toDate=messages.StringField(2),
+    week=messages.StringField(3),
+    fields=messages.StringField(4, repeated=True),
+    pageSize=messages.IntegerField(5, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(6),
+)
+
+SESSION_FIELDS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    fields=messages.StringField(1, repeated=True),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
 )
 
 WISHLIST_GET_REQUEST = endpoints.ResourceContainer(
@@ -120,53 +244,182 @@ WISHLIST_DURATION_GET_REQUEST = endpoints.ResourceContainer(
     duration=messages.IntegerField(1, variant=messages.Variant.INT32),
 )
 
+SPEAKERS_GET_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    prefix=messages.StringField(1),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    pageToken=messages.StringField(3),
+)
+
 SPEAKER_POST_REQUEST = endpoints.ResourceContainer(
     SpeakerMiniForm,
     websafeSpeakerKey=messages.StringField(1),
 )
 
+# entity -> form copy plans, built once at import
+CONFERENCE_FORM_PLAN = serializers.plan(Conference, ConferenceForm,
+    converters={'startDate': str, 'endDate': str},
+    computed={'websafeKey': serializers.websafeKey})
+
+PROFILE_FORM_PLAN = serializers.plan(Profile, ProfileForm,
+    converters={'teeShirtSize': lambda size: getattr(TeeShirtSize, size)})
+
+SESSION_FORM_PLAN = serializers.plan(Session, SessionForm,
+    converters={'date': str, 'startTime': str},
+    computed={'confWebsafeKey': serializers.websafeParentKey,
+              'websafeKey': serializers.websafeKey})
+
+WISHLIST_FORM_PLAN = serializers.plan(Wishlist, WishlistForm,
+    computed={'websafeKey': serializers.websafeKey})
+
+SPEAKER_FORM_PLAN = serializers.plan(Speaker, SpeakerForm,
+    computed={'websafeKey': serializers.websafeKey})
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 
+def _matchesFilters(entity, filters):
+    """True if entity passes every filter, as the datastore would apply
+    it; a repeated property passes if any of its values does.
+    """
+    for filtr in filters:
+        value = getattr(entity, filtr["field"])
+        test = PREDICATES[filtr["operator"]]
+        if isinstance(value, list):
+            if not any(test(v, filtr["value"]) for v in value):
+                return False
+        elif not test(value, filtr["value"]):
+            return False
+    return True
+
+
+def _reportContention(method):
+    """Turn a TransactionFailedError from method into a 503 that names
+    it, so clients can tell datastore contention from other errors.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except datastore_errors.TransactionFailedError, e:
+            raise ContentionException('TransactionFailedError: %s' % e)
+    return wrapper
+
+
 @endpoints.api(name='conference', version='v1', audiences=[ANDROID_AUDIENCE],
     allowed_client_ids=[WEB_CLIENT_ID, API_EXPLORER_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID],
     scopes=[EMAIL_SCOPE])
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    @property
+    def _context(self):
+        """The RequestContext shared by this request's helpers."""
+        if getattr(self, '_requestContext', None) is None:
+            self._requestContext = RequestContext()
+        return self._requestContext
+
+    def initialize_request_state(self, request_state):
+        super(ConferenceApi, self).initialize_request_state(request_state)
+        self._requestContext = None
+
     def _getAuthUser(self):
         """ Make sure user is logged in and return the user record """ 
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        
-        return user
+        return self._context.user
+
+    def _pageSize(self, pageSize):
+        """Clamp a client supplied page size to a sane value."""
+        if not pageSize:
+            return DEFAULT_PAGE_SIZE
+        if pageSize < 0:
+            raise endpoints.BadRequestException("'pageSize' must be positive")
+        return min(pageSize, MAX_PAGE_SIZE)
+
+    def _pageCursor(self, pageToken):
+        """Turn an opaque page token back into a datastore Cursor."""
+        if not pageToken:
+            return None
+        try:
+            return Cursor(urlsafe=pageToken)
+        except Exception:
+            raise endpoints.BadRequestException("Invalid 'pageToken'")
+
+    def _fetchPage(self, q, pageSize, pageToken, **options):
+        """Fetch one page of q, returning (results, nextPageToken)."""
+        results, cursor, more = q.fetch_page(self._pageSize(pageSize),
+            start_cursor=self._pageCursor(pageToken), **options)
+        if more and cursor:
+            return results, cursor.urlsafe()
+        return results, None
+
+    def _fieldMask(self, plan, fields):
+        """Return (masked copy plan, mask) for a client supplied field mask.
+
+        An empty mask means all fields, and a mask of None.
+        """
+        if not fields:
+            return plan, None
+        unknown = set(fields) - plan.fieldNames
+        if unknown:
+            raise endpoints.BadRequestException(
+                "Unknown field(s) in mask: %s" % ', '.join(sorted(unknown)))
+        return plan.only(fields), frozenset(fields)
+
+    def _maskOptions(self, model, mask, needed=(), index=None):
+        """Return query options that read only what mask needs.
+
+        Fields computed from the key need nothing, so a mask of only those
+        becomes a keys-only query, which any query can run as.  A
+        projection needs an index holding every projected property in the
+        query's order, so we only project when the built-in index the query
+        scans already is one: the mask (plus any property in needed, e.g.
+        for filtering in Python) must be just index, the property of a
+        query with no ancestor or equality filter that is filtered or
+        ordered on nothing else.  Otherwise we fetch whole entities and
+        only the masked fields are serialized.
+        """
+        if mask is None:
+            return {}
+        projection = [name for name in mask | frozenset(needed)
+                      if isinstance(getattr(model, name, None), ndb.Property)]
+        if not projection:
+            return {'keys_only': True}
+        if projection == [index] and not getattr(model, index)._repeated:
+            return {'projection': projection}
+        return {}
+
+    def _maskedFetchPage(self, model, q, options, pageSize, pageToken):
+        """Like _maskedFetch for one page, returning (results, nextPageToken)."""
+        results, nextPageToken = self._fetchPage(q, pageSize, pageToken,
+                                                 **options)
+        if options.get('keys_only'):
+            results = [model(key=key) for key in results]
+        return results, nextPageToken
+
+    def _maskedFetch(self, model, q, options, **kwargs):
+        """Fetch q with mask options, returning model instances."""
+        results = q.fetch(**dict(kwargs, **options))
+        if options.get('keys_only'):
+            return [model(key=key) for key in results]
+        return results
     
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
-    def _copyConferenceToForm(self, conf, displayName):
-        """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
+    def _copyConferenceToForm(self, conf, displayName, seatsAvailable=None):
+        """Copy relevant fields from Conference to ConferenceForm.
+
+        seatsAvailable overrides the (lagged) Conference.seatsAvailable
+        roll-up with an exact count summed from the seat shards.
+        """
+        return CONFERENCE_FORM_PLAN.copy(conf,
+            organizerDisplayName=displayName or None,
+            seatsAvailable=seatsAvailable)
 
 
     def _createConferenceObject(self, request):
         """Create or update Conference object, returning ConferenceForm/request."""
         # preload necessary data items
-        user = self._getAuthUser()
-        user_id = getUserId(user)
+        user_id = self._context.userId
         
         if not request.name:
             raise endpoints.BadRequestException("Conference 'name' field required")
@@ -174,7 +427,8 @@ class ConferenceApi(remote.Service):
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
         del data['websafeKey']
-        del data['organizerDisplayName']
+        for name in VERSION_FIELDS:
+            del data[name]
 
         # add default values for those missing (both data model & outbound Message)
         for df in DEFAULTS:
@@ -196,30 +450,30 @@ class ConferenceApi(remote.Service):
             data["seatsAvailable"] = data["maxAttendees"]
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
-        p_key = ndb.Key(Profile, user_id)
+        p_key = self._context.profileKey
         c_id = Conference.allocate_ids(size=1, parent=p_key)[0]
         c_key = ndb.Key(Conference, c_id, parent=p_key)
         data['key'] = c_key
         data['organizerUserId'] = request.organizerUserId = user_id
+        data['organizerDisplayName'] = request.organizerDisplayName = \
+            self._getProfileFromUser().displayName
 
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
         Conference(**data).put()
-        taskqueue.add(params={'email': user.email(),
+        self._conferencesChanged(c_key)
+        taskqueue.add(params={'email': self._context.user.email(),
             'conferenceInfo': repr(request)},
             url='/tasks/send_confirmation_email'
         )
         return request
 
 
-    @ndb.transactional()
+    @_reportContention
+    @ndb.transactional(xg=True)
     def _updateConferenceObject(self, request):
         
-        user = self._getAuthUser()
-        user_id = getUserId(user)
-
-        # copy ConferenceForm/ProtoRPC Message into dict
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
+        user_id = self._context.userId
 
         # update existing conference
         conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
@@ -235,10 +489,14 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        stored = conf.seatsAvailable or 0
         for field in request.all_fields():
             data = getattr(request, field.name)
-            # only copy fields where we get data
-            if data not in (None, []):
+            # only copy fields where we get data; the organiser's name
+            # always comes from their Profile, and the key and version
+            # fields aren't stored
+            if data not in (None, []) and field.name not in \
+                    ('organizerDisplayName', 'websafeKey') + VERSION_FIELDS:
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
@@ -246,9 +504,17 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        # seats changed from the rolled-up value the client saw; apply the
+        # difference to the shards, so registrations since then stand and
+        # an echoed value changes nothing
+        if request.seatsAvailable is not None and conf.seatShards:
+            conf.seatsAvailable = stored
+            if request.seatsAvailable != stored:
+                conf.seatsAvailable = seats.adjustShards(
+                    conf, request.seatsAvailable - stored)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return self._copyConferenceToForm(conf,
+                                          self._legacyOrganizerName(conf))
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
             http_method='POST', name='createConference')
@@ -261,55 +527,161 @@ class ConferenceApi(remote.Service):
             http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        cf = self._updateConferenceObject(request)
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        self._conferencesChanged(c_key)
+        if request.seatsAvailable is not None:
+            self._nearlySoldOutChanged(c_key.get())
+        return cf
 
-    @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
+    @endpoints.method(CONF_VERSION_GET_REQUEST, ConferenceForm,
             path='conference/{websafeConferenceKey}',
             http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
+        # serve the rendered ConferenceForm from memcache while it's current;
+        # its generation also versions the response
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        cache_key = MEMCACHE_CONFERENCE_KEY % c_key.urlsafe()
+        cf, gen = cache.getMessage(cache_key, cache_key, ConferenceForm)
+        version = self._version(cache_key, gen)
+        if self._notModified(request, version):
+            return ConferenceForm(version=version, notModified=True)
+        if cf:
+            cf.version = version
+            return cf
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = c_key.get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
+        # return ConferenceForm with the exact seat count
+        cf = self._copyConferenceToForm(conf, self._legacyOrganizerName(conf),
+                                        seats.seatsAvailable(conf))
+        cache.setMessage(cache_key, gen, cf)
+        cf.version = version
+        return cf
+
+
+    @staticmethod
+    def _legacyOrganizerName(conf):
+        """Return the organiser's displayName for a conference saved before
+        organizerDisplayName was stored on it, else None.
+        """
+        if conf.organizerDisplayName is not None:
+            return None
         prof = conf.key.parent().get()
-        # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return getattr(prof, 'displayName', None)
+
+
+    @staticmethod
+    def _notModified(request, version):
+        """True if the client sent the version it holds as ifNoneMatch
+        and it is still current.
+        """
+        return bool(request.ifNoneMatch) and request.ifNoneMatch == version
+
+
+    @staticmethod
+    def _version(name, gen, mask=None):
+        """Return the version token for generation gen of name, as read
+        with field mask mask.
+
+        Tokens are opaque and differ between names and masks, so a version
+        sent for the wrong conference or user, or for fewer fields than
+        now asked for, never matches.
+        """
+        text = u'%s:%s' % (name, gen)
+        if mask is not None:
+            text += u':' + u','.join(sorted(mask))
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+    @staticmethod
+    def _textVersion(text):
+        """Return the version of a cached announcement string."""
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+    @staticmethod
+    def _conferencesChanged(*c_keys):
+        """Invalidate cached ConferenceForms and conference query results;
+        call after the write commits.
+        """
+        cache.bump(CONFERENCES_GENERATION,
+                   *[MEMCACHE_CONFERENCE_KEY % c_key.urlsafe()
+                     for c_key in c_keys])
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='getConferencesCreated',
             http_method='POST', name='getConferencesCreated')
+    @ndb.synctasklet
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
-        # make sure user is authed
-        user = self._getAuthUser()
-        user_id = getUserId(user)
-
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = yield Conference.query(ancestor=self._context.profileKey).fetch_async()
+        organisers = {}
+        for conf in confs:
+            self._getOrganiserAsync(organisers, conf)
+
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, getattr(prof, 'displayName')) for conf in confs]
-        )
+        items = yield self._copyConferencesToFormsAsync(confs, organisers)
+        raise ndb.Return(ConferenceForms(items=items))
+
+
+    @staticmethod
+    def _streamedFilters(inequality_field, filters):
+        """Return the filters of a conference query applied while
+        streaming rather than by the datastore.
+
+        A query mixing equality filters with an inequality would need a
+        composite index per shape, each written on every conference write
+        and seat roll-up.  Instead its equality filters run as a zigzag
+        merge join of the built-in indexes and the inequality is checked
+        on each result.
+        """
+        if inequality_field and any(f["operator"] == "=" for f in filters):
+            return [f for f in filters if f["operator"] != "="]
+        return []
+
+    @staticmethod
+    def _conferenceOrders(inequality_field, filters):
+        """Return the sort orders of a conference query, as property names.
 
+        Every query is ordered so the built-in single-property indexes
+        serve it: by name when unfiltered, by key when the datastore only
+        sees equality filters (see _streamedFilters) and by the inequality
+        field, then key, when there is only an inequality.
+        index_advisor.py checks index.yaml against this.
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
+        Every order ends in the key: a != filter runs as two queries
+        merged by ndb, which only gives cursors for such orders.
+        """
+        if ConferenceApi._streamedFilters(inequality_field, filters):
+            return ['__key__']
+        if inequality_field:
+            return [inequality_field, '__key__']
+        if filters:
+            return ['__key__']
+        return ['name', '__key__']
+
+    def _getQuery(self, inequality_filter, filters):
+        """Return the datastore query for the submitted filters, without
+        those applied while streaming.
+        """
         q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
+        streamed = self._streamedFilters(inequality_filter, filters)
 
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
-        else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
+        for name in self._conferenceOrders(inequality_filter, filters):
+            if name == '__key__':
+                q = q.order(Conference.key)
+            else:
+                q = q.order(ndb.GenericProperty(name))
 
         for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
+            if filtr in streamed:
+                continue
             formatted_query = ndb.query.FilterNode(filtr["field"], filtr["operator"], filtr["value"])
             q = q.filter(formatted_query)
         return q
@@ -329,6 +701,13 @@ class ConferenceApi(remote.Service):
             except KeyError:
                 raise endpoints.BadRequestException("Filter contains invalid field or operator.")
 
+            if filtr["field"] in ["month", "maxAttendees"]:
+                try:
+                    filtr["value"] = int(filtr["value"])
+                except (TypeError, ValueError):
+                    raise endpoints.BadRequestException(
+                        "Filter on %s needs an integer value." % filtr["field"])
+
             # Every operation except "=" is an inequality
             if filtr["operator"] != "=":
                 # check if inequality operation has been used in previous filters
@@ -346,64 +725,133 @@ class ConferenceApi(remote.Service):
             path='queryConferences',
             http_method='POST',
             name='queryConferences')
+    @ndb.synctasklet
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId)) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        """Query for conferences, one page at a time."""
+        plan, mask = self._fieldMask(CONFERENCE_FORM_PLAN, request.fields)
+        inequality_filter, filters = self._formatFilters(request.filters)
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        # answer repeated searches from memcache while no conference
+        # has been written since
+        cache_key = MEMCACHE_CONFERENCE_QUERY_KEY % self._querySignature(
+            request, filters, mask)
+        cfs, gen = cache.getMessage(cache_key, CONFERENCES_GENERATION,
+                                    ConferenceForms)
+        if cfs is not None:
+            raise ndb.Return(cfs)
+
+        q = self._getQuery(inequality_filter, filters)
+        streamed = self._streamedFilters(inequality_filter, filters)
+        # an unfiltered query, or one with only an inequality, scans the
+        # built-in index of its first order
+        index = self._conferenceOrders(inequality_filter, filters)[0]
+        options = self._maskOptions(Conference, mask,
+                                    [f["field"] for f in streamed],
+                                    index if index != '__key__' else None)
+        conferences, organisers, nextPageToken = \
+            yield self._streamConferencesAsync(q, request, mask, options,
+                                               streamed)
 
         # return individual ConferenceForm object per Conference
-        return ConferenceForms(
-                items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in \
-                conferences]
+        items = yield self._copyConferencesToFormsAsync(conferences, organisers,
+                                                        plan)
+        cfs = ConferenceForms(items=items, nextPageToken=nextPageToken)
+        cache.setMessage(cache_key, gen, cfs, ttl=CONFERENCE_QUERY_CACHE_SECS)
+        raise ndb.Return(cfs)
+
+
+    @ndb.tasklet
+    def _streamConferencesAsync(self, q, request, mask, options, streamed):
+        """Return (conferences, organisers, nextPageToken) for one page of q,
+        applying the streamed filters.
+
+        The query is streamed once (the same way ndb's fetch_page does),
+        starting any organiser Profile lookup we need as soon as we see a
+        new organiser so it overlaps with the remaining batches.
+        """
+        pageSize = self._pageSize(request.pageSize)
+        # stop a streamed page after reading our share of entities
+        it = q.iter(limit=None if streamed else pageSize + 1,
+            batch_size=pageSize, produce_cursors=True,
+            start_cursor=self._pageCursor(request.pageToken), **options)
+        needNames = mask is None or 'organizerDisplayName' in mask
+        conferences = []
+        organisers = {}
+        scanned = 0
+        while (yield it.has_next_async()):
+            conf = it.next()
+            scanned += 1
+            if options.get('keys_only'):
+                conf = Conference(key=conf)
+            if _matchesFilters(conf, streamed):
+                conferences.append(conf)
+                if needNames:
+                    self._getOrganiserAsync(organisers, conf)
+            if (len(conferences) >= pageSize or
+                    scanned >= pageSize * QUERY_SCAN_FACTOR):
+                break
+
+        nextPageToken = None
+        if scanned and it.probably_has_next():
+            nextPageToken = it.cursor_after().urlsafe()
+        raise ndb.Return((conferences, organisers, nextPageToken))
+
+
+    def _querySignature(self, request, filters, mask):
+        """Return a hash identifying the query, page and field mask a
+        request asks for.
+
+        filters are as returned by _formatFilters; they are normalized
+        (field, operator, coerced value) and sorted, so equivalent filter
+        lists share a cache entry.
+        """
+        signature = (
+            sorted((f["field"], f["operator"], f["value"]) for f in filters),
+            self._pageSize(request.pageSize),
+            request.pageToken or None,
+            sorted(mask) if mask else None,
         )
+        return hashlib.sha1(repr(signature)).hexdigest()
+
+
+    def _getOrganiserAsync(self, organisers, conf):
+        """Start fetching conf's organiser Profile unless already started.
+
+        Only needed for conferences saved before organizerDisplayName
+        was stored on them.
+        """
+        p_key = conf.key.parent()
+        if conf.organizerDisplayName is None and p_key not in organisers:
+            organisers[p_key] = p_key.get_async()
+
+
+    @ndb.tasklet
+    def _copyConferencesToFormsAsync(self, conferences, organisers,
+                                     plan=CONFERENCE_FORM_PLAN):
+        """Wait for organiser Profiles, then copy conferences to forms.
+
+        Missing conferences are skipped; a missing organiser Profile just
+        leaves organizerDisplayName empty.
+        """
+        profiles = yield organisers.values()
+        names = dict((prof.key, prof.displayName)
+                     for prof in profiles if prof)
+        conferences = [conf for conf in conferences if conf]
+        raise ndb.Return(plan.copyAll(conferences,
+            organizerDisplayName=[names.get(conf.key.parent())
+                                  for conf in conferences]))
 
 # - - - Profile objects - - - - - - - - - - - - - - - - - - -
 
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return PROFILE_FORM_PLAN.copy(prof)
 
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
-        # make sure user is authed
-        user = self._getAuthUser()
-        
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
-        if not profile:
-            profile = Profile(
-                key = p_key,
-                displayName = user.nickname(),
-                mainEmail= user.email(),
-                teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
-
-        return profile      # return Profile
+        return self._context.profile
 
 
     def _doProfile(self, save_request=None):
@@ -413,6 +861,7 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            displayName = prof.displayName
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -424,15 +873,80 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, val)
                         prof.put()
 
-        # return ProfileForm
-        return self._copyProfileToForm(prof)
+            self._profileChanged(self._context.userId)
+
+            # copy the new name onto the user's conferences in the background
+            if prof.displayName != displayName:
+                taskqueue.add(params={'profile_key': prof.key.urlsafe()},
+                    url='/tasks/update_organizer_name'
+                )
+
+        # return ProfileForm, listing both migrated and legacy registrations
+        pf = self._copyProfileToForm(prof)
+        pf.conferenceKeysToAttend = [wsck.urlsafe() for wsck in
+                                     self._getConferenceKeysToAttend(prof)]
+        return pf
+
+
+    def _getConferenceKeysToAttend(self, prof):
+        """Return keys of the conferences the Profile's user registered for."""
+        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
+        for r_key in Registration.query(ancestor=prof.key).fetch(keys_only=True):
+            c_key = ndb.Key(urlsafe=r_key.id())
+            if c_key not in conf_keys:
+                conf_keys.append(c_key)
+        return conf_keys
 
 
-    @endpoints.method(message_types.VoidMessage, ProfileForm,
+    @staticmethod
+    def _updateOrganizerName(p_key, cursor=None, batchSize=100):
+        """Copy a Profile's displayName onto one batch of its Conferences;
+        used by the update_organizer_name task.
+
+        Returns the cursor to continue from, or None when done.
+        """
+        # the Conferences are in the Profile's entity group, so each batch
+        # is one transaction and can't clobber a concurrent update
+        @ndb.transactional()
+        def txn():
+            prof = p_key.get()
+            if not prof:
+                return [], None
+            displayName = prof.displayName
+            confs, next_cursor, more = Conference.query(ancestor=p_key). \
+                fetch_page(batchSize, start_cursor=cursor)
+            changed = [conf for conf in confs
+                       if conf.organizerDisplayName != displayName]
+            for conf in changed:
+                conf.organizerDisplayName = displayName
+            ndb.put_multi(changed)
+            return [conf.key for conf in changed], (next_cursor if more else None)
+
+        c_keys, cursor = txn()
+        if c_keys:
+            ConferenceApi._conferencesChanged(*c_keys)
+        return cursor
+
+
+    @endpoints.method(VERSION_GET_REQUEST, ProfileForm,
             path='profile', http_method='GET', name='getProfile')
     def getProfile(self, request):
         """Return user profile."""
-        return self._doProfile()
+        # read the version first, so a write racing with us leaves the
+        # client with an outdated version rather than outdated data
+        name = PROFILE_GENERATION % self._context.userId
+        version = self._version(name, cache.generation(name))
+        if self._notModified(request, version):
+            return ProfileForm(version=version, notModified=True)
+        pf = self._doProfile()
+        pf.version = version
+        return pf
+
+
+    @staticmethod
+    def _profileChanged(user_id):
+        """Change the getProfile version; call after the write commits."""
+        cache.bump(PROFILE_GENERATION % user_id)
 
 
     @endpoints.method(ProfileMiniForm, ProfileForm,
@@ -445,46 +959,162 @@ class ConferenceApi(remote.Service):
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
     @staticmethod
-    def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+    def _cacheAnnouncement(cursor=None, batchSize=50):
+        """Reconcile a batch of the NearlySoldOut index with the exact seat
+        counts; used by the reconcile_nearly_sold_out task as a safety net
+        behind _nearlySoldOutChanged.
+
+        Only conferences whose rolled-up seatsAvailable is in range are
+        read, plus, on the first batch, those already in the index.
+        Returns the cursor to continue from, or None when done.
         """
-        confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
-            Conference.seatsAvailable > 0)
-        ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+        c_keys, next_cursor, more = Conference.query(ndb.AND(
+            Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
+            Conference.seatsAvailable > 0)).order(
+            Conference.seatsAvailable, Conference.key).fetch_page(
+            batchSize, start_cursor=cursor, keys_only=True)
+        if cursor is None:
+            c_keys += [ndb.Key(urlsafe=key.id()) for key in
+                       NearlySoldOut.query().fetch(keys_only=True)]
+        c_keys = list(set(c_keys))
+
+        confs = ndb.get_multi(c_keys)
+        entries = ndb.get_multi([ndb.Key(NearlySoldOut, c_key.urlsafe())
+                                 for c_key in c_keys])
+        for c_key, conf, entry in zip(c_keys, confs, entries):
+            if conf is None:
+                # the conference is gone
+                if entry is not None:
+                    entry.key.delete()
+                    ConferenceApi._syncNearlySoldOutCache(c_key.urlsafe())
+            elif ConferenceApi._settleNearlySoldOut(conf, entry):
+                ConferenceApi._syncNearlySoldOutCache(c_key.urlsafe())
+        return next_cursor if more else None
+
+
+    @staticmethod
+    def _announcementText(entries):
+        """Format the announcement for a websafe key -> name dict."""
+        if not entries:
+            return ""
+        return ANNOUNCEMENT_TPL % ', '.join(sorted(entries.values()))
 
-        return announcement
+
+    @staticmethod
+    def _nearlySoldOutEntries():
+        """Return the NearlySoldOut index as a websafe key -> name dict,
+        from memcache if we can.
+        """
+        entries = memcache.get(MEMCACHE_NEARLY_SOLD_OUT_KEY)
+        if entries is None:
+            entries = dict((entry.key.id(), entry.name)
+                           for entry in NearlySoldOut.query())
+            memcache.add(MEMCACHE_NEARLY_SOLD_OUT_KEY, entries)
+        return entries
+
+
+    @staticmethod
+    def _isNearlySoldOut(count):
+        return 0 < count <= NEARLY_SOLD_OUT_SEATS
 
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
+    @staticmethod
+    def _nearlySoldOutChanged(conf):
+        """Bring conf's NearlySoldOut entry and its memcache copy in line
+        with conf's exact seat count after its seats changed.
+        """
+        wsck = conf.key.urlsafe()
+        if ConferenceApi._settleNearlySoldOut(
+                conf, ndb.Key(NearlySoldOut, wsck).get()):
+            ConferenceApi._syncNearlySoldOutCache(wsck)
+
+
+    @staticmethod
+    def _settleNearlySoldOut(conf, entry):
+        """Fix conf's NearlySoldOut entry (or None) if it disagrees with
+        conf's exact seat count; returns True if the entry changed.
+
+        The summed shards are only a snapshot, so a disagreement is settled
+        in a transaction that reads conf, every seat shard and the entry.
+        A registration committing meanwhile makes it retry, so the entry
+        always ends up matching the exact count.
+        """
+        nearly = ConferenceApi._isNearlySoldOut
+        if nearly(seats.seatsAvailable(conf)) == (entry is not None):
+            return False
+
+        @ndb.transactional(xg=True)
+        def txn():
+            current = conf.key.get()
+            e_key = ndb.Key(NearlySoldOut, conf.key.urlsafe())
+            if not current:
+                return False
+            shards = ndb.get_multi(seats.shardKeys(current) + [e_key])
+            entry = shards.pop()
+            if current.seatShards:
+                count = sum(shard.seatsAvailable for shard in shards if shard)
+            else:
+                count = current.seatsAvailable
+            if nearly(count) and entry is None:
+                NearlySoldOut(key=e_key, name=current.name).put()
+                return True
+            if not nearly(count) and entry is not None:
+                e_key.delete()
+                return True
+            return False
+        return txn()
+
+
+    @staticmethod
+    def _syncNearlySoldOutCache(wsck):
+        """Copy wsck's NearlySoldOut entry into the memcache copy of the
+        index after the entry changed.
+
+        The entry is read again on every compare-and-set attempt, so of
+        two racing changes the later one wins.
+        """
+        client = memcache.Client()
+        for attempt in range(10):
+            entries = client.gets(MEMCACHE_NEARLY_SOLD_OUT_KEY)
+            if entries is None:
+                # the next reader rebuilds it from the index
+                return
+            entry = ndb.Key(NearlySoldOut, wsck).get()
+            if entry is not None:
+                entries[wsck] = entry.name
+            else:
+                entries.pop(wsck, None)
+            if client.cas(MEMCACHE_NEARLY_SOLD_OUT_KEY, entries):
+                return
+        memcache.delete(MEMCACHE_NEARLY_SOLD_OUT_KEY)
+
+
+    @endpoints.method(VERSION_GET_REQUEST, StringMessage,
             path='conference/announcement/get',
             http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
         """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        return self._versionedText(request,
+            self._announcementText(self._nearlySoldOutEntries()))
+
+
+    def _versionedText(self, request, text):
+        """Return text as a StringMessage, or an empty not-modified one.
+
+        Announcements are read from memcache, which every write path
+        already keeps up to date, so a hash of the text is their version.
+        """
+        version = self._textVersion(text)
+        if self._notModified(request, version):
+            return StringMessage(data="", version=version, notModified=True)
+        return StringMessage(data=text, version=version)
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
+    @_reportContention
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
-        prof = self._getProfileFromUser() # get user Profile
-
         # check if conf exists given websafeConfKey
         # get conference; check that it exists
         wsck = request.websafeConferenceKey
@@ -492,64 +1122,168 @@ class ConferenceApi(remote.Service):
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
+        conf = seats.ensureShards(conf)
+
+        # unregister, giving the seat back to any shard
+        if not reg:
+            retval, shardSeats = self._conferenceRegistrationTxn(
+                wsck, seats.anyShard(conf), reg=False)
+
+        # register, taking a seat from a shard that has one.  A shard may
+        # run dry between looking at it and our transaction, so move on
+        # to the next; only once every shard reads as empty are we sold out
+        else:
+            retval = None
+            while retval is None:
+                sh_keys = seats.shardsWithSeats(conf)
+                if not sh_keys:
+                    raise ConflictException(
+                        "There are no seats available.")
+                for sh_key in sh_keys:
+                    retval, shardSeats = self._conferenceRegistrationTxn(
+                        wsck, sh_key)
+                    if retval is not None:
+                        break
+
+        if retval:
+            self._profileChanged(self._context.userId)
+            seats.seatsChanged(conf.key)
+            # the total can only cross the threshold if the shard we
+            # changed held no more seats than that before or after
+            before = shardSeats + 1 if reg else shardSeats - 1
+            if min(before, shardSeats) <= NEARLY_SOLD_OUT_SEATS:
+                self._nearlySoldOutChanged(conf)
+            self._conferencesChanged(conf.key)
+        return BooleanMessage(data=retval)
+
+
+    @ndb.transactional(xg=True)
+    def _conferenceRegistrationTxn(self, wsck, sh_key, reg=True):
+        """Move one seat between seat shard sh_key and the user's Registration.
+
+        Returns (result, seats left in the shard).  result is None if
+        registering and the shard has no seats left, and False if
+        unregistering a user who isn't registered.
+        """
+        p_key = self._context.profileKey
+        c_key = ndb.Key(urlsafe=wsck)
+        r_key = Registration.keyFor(p_key, c_key)
+        registration, prof, shard = ndb.get_multi([r_key, p_key, sh_key])
+
+        # registrations not yet migrated off Profile.conferenceKeysToAttend
+        legacy = prof is not None and wsck in prof.conferenceKeysToAttend
 
         # register
         if reg:
             # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if registration or legacy:
                 raise ConflictException(
                     "You have already registered for this conference")
 
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
-                raise ConflictException(
-                    "There are no seats available.")
+            # check if seats avail in this shard
+            if shard.seatsAvailable <= 0:
+                return None, shard.seatsAvailable
 
             # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
+            shard.seatsAvailable -= 1
+            ndb.put_multi([Registration(key=r_key, conferenceKey=c_key), shard])
 
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
-
-                # unregister user, add back one seat
+            if not (registration or legacy):
+                return False, shard.seatsAvailable
+
+            # unregister user, add back one seat
+            shard.seatsAvailable += 1
+            if registration:
+                r_key.delete()
+            if legacy:
                 prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
+                ndb.put_multi([prof, shard])
             else:
-                retval = False
+                shard.put()
+
+        return True, shard.seatsAvailable
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+
+    @staticmethod
+    def _migrateRegistrations(cursor=None, batchSize=100):
+        """Move a batch of Profiles' conferenceKeysToAttend lists to
+        Registration entities; used by the migrate_registrations task.
+
+        Returns the cursor to continue from, or None when done.
+        """
+        @ndb.transactional()
+        def migrate(p_key):
+            prof = p_key.get()
+            if not prof.conferenceKeysToAttend:
+                return False
+            regs = []
+            for wsck in prof.conferenceKeysToAttend:
+                try:
+                    c_key = ndb.Key(urlsafe=wsck)
+                except Exception:
+                    continue
+                regs.append(Registration(key=Registration.keyFor(p_key, c_key),
+                                         conferenceKey=c_key))
+            prof.conferenceKeysToAttend = []
+            ndb.put_multi(regs + [prof])
+            return True
+
+        p_keys, cursor, more = Profile.query().fetch_page(batchSize,
+            start_cursor=cursor, keys_only=True)
+        for p_key in p_keys:
+            # the migrated registrations are listed in a different order
+            if migrate(p_key):
+                ConferenceApi._profileChanged(p_key.id())
+        return cursor if more else None
+
+
+    @endpoints.method(CONF_ATTENDEES_GET_REQUEST, ProfileForms,
+            path='conference/{websafeConferenceKey}/attendees',
+            http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """Return profiles registered for a conference (organiser only)."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        if c_key.parent() != self._context.profileKey:
+            raise endpoints.ForbiddenException(
+                'Only the owner can list the attendees.')
+
+        # registrations are keyed under the attendee's Profile
+        r_keys, nextPageToken = self._fetchPage(
+            Registration.query(Registration.conferenceKey == c_key),
+            request.pageSize, request.pageToken, keys_only=True)
+        profiles = ndb.get_multi([r_key.parent() for r_key in r_keys])
+
+        # don't reveal the attendees' other registrations
+        items = []
+        for prof in profiles:
+            if prof:
+                pf = self._copyProfileToForm(prof)
+                pf.conferenceKeysToAttend = []
+                items.append(pf)
+        return ProfileForms(items=items, nextPageToken=nextPageToken)
 
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
             path='conferences/attending',
             http_method='GET', name='getConferencesToAttend')
+    @ndb.synctasklet
     def getConferencesToAttend(self, request):
         """Get list of conferences that user has registered for."""
         prof = self._getProfileFromUser() # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId) for conf in conferences]
-        profiles = ndb.get_multi(organisers)
+        conf_keys = self._getConferenceKeysToAttend(prof)
 
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        conferences = yield ndb.get_multi_async(conf_keys)
+        organisers = {}
+        for conf in conferences:
+            if conf:
+                self._getOrganiserAsync(organisers, conf)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])\
-         for conf in conferences]
-        )
+        items = yield self._copyConferencesToFormsAsync(conferences, organisers)
+        raise ndb.Return(ConferenceForms(items=items))
 
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
@@ -584,7 +1318,7 @@ class ConferenceApi(remote.Service):
         q = q.filter(Conference.month==6)
 
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, "") for conf in q]
+            items=CONFERENCE_FORM_PLAN.copyAll(q)
         )
 
 # - - - Session object - - - - - - - - - - - - - - - - - - - -
@@ -592,33 +1326,12 @@ class ConferenceApi(remote.Service):
 
     def _copySessionToForm(self, sess):
         """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(sess, field.name):
-                
-                # convert Date and Start Time to date string; just copy others
-                if field.name == "date" or field.name == "startTime":
-                    setattr(sf, field.name, str(getattr(sess, field.name)))
-                else:
-                    setattr(sf, field.name, getattr(sess, field.name))
-            elif field.name == "confWebsafeKey":
-                setattr(sf, field.name, sess.key.parent().urlsafe())
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, sess.key.urlsafe())
-        
-        sf.check_initialized()
-        return sf
-
-    def _createSessionObject(self, request):
-        """Create Session object, returning SessionForm/request."""
-        
-        user = self._getAuthUser()
-        user_id = getUserId(user)
+        return SESSION_FORM_PLAN.copy(sess)
 
+    def _sessionData(self, request):
+        """Check a SessionForm and convert it to Session properties."""
         if not request.name:
             raise endpoints.BadRequestException("Session 'name' field required")
- 
-        speaker = None;
         #if not request.speaker:
         #    raise endpoints.BadRequestException("Session 'speaker' field required")
 
@@ -633,72 +1346,170 @@ class ConferenceApi(remote.Service):
         if data['startTime']:
             data['startTime'] = datetime.strptime(data['startTime'][:5], "%H:%M").time()
         
+        # store the canonical form, getSessionsBySpeaker filters on it
         if data['websafeSpeakerKey']:
-            
             try: 
-                sp_key = ndb.Key(urlsafe=data['websafeSpeakerKey'])
+                data['websafeSpeakerKey'] = \
+                    ndb.Key(urlsafe=data['websafeSpeakerKey']).urlsafe()
             except Exception, e:
                 raise endpoints.NotFoundException ("invalid websafeSpeakerKey")
 
-            speaker = sp_key.get()
-            
-            if not speaker:
-                raise endpoints.BadRequestException("Cannot locate speaker")
-
-        # use the Conference Key to generate a ID for the Session
-        # create Session key with Conference as the parent
-        c_key = ndb.Key(urlsafe=data['confWebsafeKey'])
-        s_id = Session.allocate_ids(size=1, parent=c_key)[0]
-        s_key = ndb.Key(Session, s_id, parent=c_key)
-        
-        # assign the Session key
-        data['key'] = s_key
-        
-        del data['confWebsafeKey']
         del data['websafeKey']
-        
-        
-        # create Session & create/update speaker if available
-        session = Session(**data)
-        session.put()
-        
-        if speaker:
-            # append the Session that the Speaker will speak
-            speaker.sessionKeysToSpeak.append(s_key.urlsafe())
-            speaker.put()
-        
-            taskqueue.add(params={'conference_key': c_key.urlsafe(),
-                'speaker_key': data['websafeSpeakerKey']},
-                url='/tasks/set_featured_speaker'
-            )
-        
-        return self._copySessionToForm(session)
+        return data
 
 
-    @endpoints.method(SessionForm, SessionForm, path='session',
-            http_method='POST', name='createSession')
-    def createSession(self, request):
-        """Create new session."""
-        
-        # make sure user is authed
-        user = self._getAuthUser()
-        user_id = getUserId(user)
-        
-        p_key = ndb.Key(Profile, user_id)
-        
-        conf = ndb.Key(urlsafe=request.confWebsafeKey).get()
+    def _createSessionObjects(self, requests):
+        """Create one conference's Session objects in bulk, returning their
+        SessionForms.
+
+        A batch is limited to one conference so it commits in a single
+        transaction: either every Session is created or none is.  Ids are
+        allocated with one call, the Sessions are written with one
+        put_multi, and one featured speaker aggregate is updated per
+        speaker.  Speakers are only read; their sessions are found
+        through Session.websafeSpeakerKey.
+        """
+        p_key = self._context.profileKey
+
+        datas = [self._sessionData(request) for request in requests]
+        if len(set(data['confWebsafeKey'] for data in datas)) > 1:
+            raise endpoints.BadRequestException(
+                "All sessions in a batch must belong to one conference")
+        try:
+            c_key = ndb.Key(urlsafe=datas[0]['confWebsafeKey'] or '')
+        except Exception, e:
+            raise endpoints.NotFoundException("invalid confWebsafeKey")
+
+        # look up the conference and every speaker involved in one go
+        sp_keys = []
+        for data in datas:
+            del data['confWebsafeKey']
+            if data['websafeSpeakerKey']:
+                sp_key = ndb.Key(urlsafe=data['websafeSpeakerKey'])
+                if sp_key not in sp_keys:
+                    sp_keys.append(sp_key)
+        found = ndb.get_multi([c_key] + sp_keys)
+        conf = found[0]
+        speakers = dict(zip(sp_keys, found[1:]))
+
         if not conf:
             raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-        
+                'No conference found with key: %s' % c_key.urlsafe())
         # Logged in user can only create Sessions for Conferences they created
         if conf.key.parent() != p_key:
             raise endpoints.UnauthorizedException('Unauthorized Access')
+        if not all(speakers.values()):
+            raise endpoints.BadRequestException("Cannot locate speaker")
+
+        # use the Conference Key to generate IDs for the Sessions in one
+        # allocation; create Session keys with the Conference as the parent
+        first, last = Session.allocate_ids(size=len(datas), parent=c_key)
+        sessions = [Session(key=ndb.Key(Session, s_id, parent=c_key), **data)
+                    for s_id, data in zip(range(first, last + 1), datas)]
 
+        # create the Sessions together with their featured speaker
+        # aggregates
+        self._saveConferenceSessions(conf, sessions, speakers)
+        self._sessionsChanged(c_key)
+
+        return SESSION_FORM_PLAN.copyAll(sessions)
+
+
+    def _saveConferenceSessions(self, conf, sessions, speakers):
+        """Put one conference's new Sessions and update the per-speaker
+        aggregates in one transaction, then refresh its featured speaker.
+
+        speakers maps the Speaker keys involved to their entities.
+        """
+        @ndb.transactional()
+        def txn():
+            sp_keys = []
+            for sess in sessions:
+                if sess.websafeSpeakerKey and sess.websafeSpeakerKey not in sp_keys:
+                    sp_keys.append(sess.websafeSpeakerKey)
+            a_keys = [ndb.Key(SpeakerSessions, wssk, parent=conf.key)
+                      for wssk in sp_keys]
+            aggregates = dict(zip(sp_keys, ndb.get_multi(a_keys)))
+            for wssk, a_key in zip(sp_keys, a_keys):
+                if not aggregates[wssk]:
+                    aggregates[wssk] = SpeakerSessions(key=a_key)
+                aggregates[wssk].speakerName = \
+                    speakers[ndb.Key(urlsafe=wssk)].name
+
+            for sess in sessions:
+                if sess.websafeSpeakerKey:
+                    aggregate = aggregates[sess.websafeSpeakerKey]
+                    aggregate.sessionNames.append(sess.name)
+                    aggregate.sessionCount += 1
+
+            # the featured speaker can only change if one of ours now has
+            # more than one session; pick it the way getFeaturedSpeaker does
+            featured = None
+            if any(aggregate.sessionCount > 1
+                   for aggregate in aggregates.values()):
+                candidates = aggregates.values()
+                top = self._featuredSpeakerQuery(conf.key).get()
+                if top and top.key.id() not in aggregates:
+                    candidates.append(top)
+                featured = min(candidates, key=self._featuredRank)
+            ndb.put_multi(sessions + aggregates.values())
+            return featured
+
+        featured = txn()
+        if featured:
+            cache_key = MEMCACHE_FEATURED_SPEAKER_KEY % conf.key.urlsafe()
+            cache.replace(cache_key, cache_key,
+                          self._featuredSpeakerText(conf, featured))
+
+
+    @staticmethod
+    def _featuredSpeakerQuery(c_key):
+        """Return a query for c_key's SpeakerSessions, featured first."""
+        return SpeakerSessions.query(ancestor=c_key). \
+            order(-SpeakerSessions.sessionCount, SpeakerSessions.key)
+
+
+    @staticmethod
+    def _featuredRank(aggregate):
+        """Sort key matching _featuredSpeakerQuery: the speaker with the
+        most sessions, then the lowest key.
+        """
+        return -aggregate.sessionCount, aggregate.key.id()
+
+
+    @staticmethod
+    def _featuredSpeakerText(conf, aggregate):
+        """Return the featured speaker announcement for a SpeakerSessions."""
+        return FEATURED_SPEAKERS_TPL % (conf.name, aggregate.speakerName,
+                                        ', '.join(aggregate.sessionNames))
+
+
+    def _createSessionObject(self, request):
+        """Create Session object, returning SessionForm/request."""
+        return self._createSessionObjects([request])[0]
+
+
+    @endpoints.method(SessionForm, SessionForm, path='session',
+            http_method='POST', name='createSession')
+    def createSession(self, request):
+        """Create new session."""
         return self._createSessionObject(request)
 
 
-    @endpoints.method(CONF_GET_REQUEST, SessionForms,
+    @endpoints.method(SessionForms, SessionForms, path='sessions',
+            http_method='POST', name='createSessions')
+    def createSessions(self, request):
+        """Create many sessions of one conference at once, e.g. a whole
+        agenda."""
+        if len(request.items) > MAX_SESSIONS_PER_BATCH:
+            raise endpoints.BadRequestException(
+                "At most %d sessions per request" % MAX_SESSIONS_PER_BATCH)
+        if not request.items:
+            return SessionForms()
+        return SessionForms(items=self._createSessionObjects(request.items))
+
+
+    @endpoints.method(SESSIONS_GET_REQUEST, SessionForms,
             path='getConferenceSessions/{websafeConferenceKey}',
             http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
@@ -708,14 +1519,32 @@ class ConferenceApi(remote.Service):
         user = self._getAuthUser()
         
         c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        plan, mask = self._fieldMask(SESSION_FORM_PLAN, request.fields)
+
+        # read the version before the sessions; see getProfile
+        name = CONFERENCE_SESSIONS_GENERATION % c_key.urlsafe()
+        version = self._version(name, cache.generation(name), mask)
+        if self._notModified(request, version):
+            return SessionForms(version=version, notModified=True)
         
         # create ancestor query for all key matches for this conference
-        sessions = Session.query(ancestor=c_key)
+        sessions = self._maskedFetch(Session, Session.query(ancestor=c_key),
+                                     self._maskOptions(Session, mask))
         
         # return set of SessionForm objects per session
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in sessions]
+            items=plan.copyAll(sessions),
+            version=version,
         )
+
+
+    @staticmethod
+    def _sessionsChanged(*c_keys):
+        """Change the getConferenceSessions version of each conference;
+        call after the write commits.
+        """
+        cache.bump(*[CONFERENCE_SESSIONS_GENERATION % c_key.urlsafe()
+                     for c_key in c_keys])
         
     @endpoints.method(SESSION_TYPE_GET_REQUEST, SessionForms,
             path='getConferenceSessionsByType',
@@ -724,11 +1553,13 @@ class ConferenceApi(remote.Service):
         """Find specific type of sessions for a conference """
         
         c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        plan, mask = self._fieldMask(SESSION_FORM_PLAN, request.fields)
         q = Session.query(ancestor=c_key). \
                 filter(Session.typeOfSession==request.typeOfSession)
                 
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
+            items=plan.copyAll(self._maskedFetch(Session, q,
+                self._maskOptions(Session, mask)))
         )
 
 
@@ -736,12 +1567,36 @@ class ConferenceApi(remote.Service):
             path='getSessionsBySpeaker',
             http_method='GET', name='getSessionsBySpeaker')
     def getSessionsBySpeaker(self, request):
-        """Find all sessions by the speaker across all conferences"""
-        
-        q = Session.query(Session.speaker==request.speaker)
-        
+        """Find all sessions by the speaker across all conferences, a page
+        at a time.
+
+        The page's keys come from the built-in websafeSpeakerKey index and
+        the Sessions from one get_multi.  speaker is accepted as an older
+        name for websafeSpeakerKey.
+        """
+        wssk = request.websafeSpeakerKey or request.speaker
+        if not wssk:
+            raise endpoints.BadRequestException(
+                "websafeSpeakerKey field required")
+        try:
+            sp_key = ndb.Key(urlsafe=wssk)
+        except Exception:
+            raise endpoints.NotFoundException("invalid websafeSpeakerKey")
+
+        plan, mask = self._fieldMask(SESSION_FORM_PLAN, request.fields)
+        q = Session.query(Session.websafeSpeakerKey == sp_key.urlsafe()). \
+                order(Session.key)
+        s_keys, nextPageToken = self._fetchPage(q, request.pageSize,
+            request.pageToken, keys_only=True)
+
+        # a mask of key-derived fields only needs the keys
+        if self._maskOptions(Session, mask).get('keys_only'):
+            sessions = [Session(key=s_key) for s_key in s_keys]
+        else:
+            sessions = [sess for sess in ndb.get_multi(s_keys) if sess]
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
+            items=plan.copyAll(sessions),
+            nextPageToken=nextPageToken
         )
 
 
@@ -749,134 +1604,326 @@ class ConferenceApi(remote.Service):
             path='getSessionsGreaterThanDate',
             http_method='GET', name='getSessionsGreaterThanDate')
     def getSessionsGreaterThanDate(self, request):
-        """Find all sessions greater than or equal to specified date across all conferences"""
-        
-        if request.date:
-            startDate = datetime.strptime(request.date[:10], "%Y-%m-%d").date()
-        
-        q = Session.query(Session.date>=startDate).order(Session.date)
+        """Find sessions greater than or equal to specified date across all
+        conferences, a page at a time"""
         
+        if not request.date:
+            raise endpoints.BadRequestException("date field required")
+
+        return self.getSessionsInDateRange(SESSION_DATE_RANGE_GET_REQUEST.
+            combined_message_class(fromDate=request.date,
+                                   fields=request.fields,
+                                   pageSize=request.pageSize,
+                                   pageToken=request.pageToken))
+
+
+    def _parseDate(self, value, name):
+        """Parse a YYYY-MM-DD request field, raising BadRequest if bad."""
+        try:
+            return datetime.strptime(value[:10], "%Y-%m-%d").date()
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "%s must be a YYYY-MM-DD date" % name)
+
+
+    @endpoints.method(SESSION_DATE_RANGE_GET_REQUEST, SessionForms,
+            path='getSessionsInDateRange',
+            http_method='GET', name='getSessionsInDateRange')
+    def getSessionsInDateRange(self, request):
+        """Find sessions across all conferences by date, a page at a time.
+
+        With week (any date in it) this is an equality filter on the
+        session's week bucket; otherwise fromDate and/or toDate (both
+        inclusive) bound a range scan of the date index.
+        """
+        plan, mask = self._fieldMask(SESSION_FORM_PLAN, request.fields)
+
+        if request.week:
+            week = weekOf(self._parseDate(request.week, 'week'))
+            q = Session.query(Session.dateWeek == week)
+            options = self._maskOptions(Session, mask, ['date'])
+        elif request.fromDate or request.toDate:
+            q = Session.query()
+            if request.fromDate:
+                q = q.filter(Session.date >=
+                             self._parseDate(request.fromDate, 'fromDate'))
+            if request.toDate:
+                q = q.filter(Session.date <=
+                             self._parseDate(request.toDate, 'toDate'))
+            options = self._maskOptions(Session, mask, ['date'], 'date')
+        else:
+            raise endpoints.BadRequestException(
+                "week, fromDate or toDate field required")
+
+        sessions, nextPageToken = self._maskedFetchPage(Session,
+            q.order(Session.date), options, request.pageSize, request.pageToken)
         return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in q]
+            items=plan.copyAll(sessions),
+            nextPageToken=nextPageToken
         )
 
-    @endpoints.method(message_types.VoidMessage, SessionForms, 
+    @endpoints.method(SESSION_FIELDS_GET_REQUEST, SessionForms, 
         path='wishlist/getSessionsNoWorkshopBefore7',
         http_method='GET', name='getSessionsNoWorkshopBefore7')
     def getSessionsNoWorkshopBefore7(self, request):
         """Return all sessions that are not workshops AND
            before 7pm (19:00)"""
-        
-        # create time object for 19:00 (7pm) and get all sessions
-        # before 19:00
-        startTime = datetime.strptime("19:00", "%H:%M").time()
-        
-        q = Session.query(Session.startTime<=startTime)
-        
-        # filter the results to exclude any workshops and return
-        # the rest
-        return SessionForms(
-            items=[self._copySessionToForm(sess) for sess in q if sess.typeOfSession != "Workshop"]
-        )
+        return self.querySessions(SessionQueryForms(
+            filters=[SessionQueryForm(field='TYPE', operator='NE',
+                                      value='Workshop'),
+                     SessionQueryForm(field='START_TIME', operator='LTEQ',
+                                      value='19:00')],
+            pageSize=request.pageSize,
+            pageToken=request.pageToken,
+            fields=request.fields))
+
+
+    def _formatSessionFilters(self, filters):
+        """Parse, check validity and format user supplied session filters."""
+        formatted_filters = []
+        for f in filters:
+            try:
+                field, parse = SESSION_FIELDS[f.field]
+                operator = OPERATORS[f.operator]
+            except KeyError:
+                raise endpoints.BadRequestException("Filter contains invalid field or operator.")
+            try:
+                value = parse(f.value)
+            except (TypeError, ValueError):
+                raise endpoints.BadRequestException(
+                    "Invalid value for %s filter: %s" % (f.field, f.value))
+            formatted_filters.append(
+                {"field": field, "operator": operator, "value": value})
+        return formatted_filters
+
+
+    def _planSessionQuery(self, filters):
+        """Split formatted session filters between datastore and Python.
+
+        Returns (equalities, inequality_field, inequalities, residual):
+        equality filters (field -> list of one value) and the one
+        inequality field (with its filters) go to the datastore; residual
+        filters, != among them, are applied to the streamed results.
+        """
+        equalities = {}
+        bounds = {}
+        residual = []
+        for filtr in filters:
+            if filtr["operator"] == "=":
+                if filtr["field"] in equalities:
+                    residual.append(filtr)
+                else:
+                    equalities[filtr["field"]] = [filtr["value"]]
+            elif filtr["operator"] != "!=":
+                bounds.setdefault(filtr["field"], []).append(filtr)
+            else:
+                # the datastore can only do != by splitting the query
+                residual.append(filtr)
+
+        # only one property may have inequality filters in the datastore;
+        # prefer one bounded on both sides, then by SESSION_INEQUALITY_PREFERENCE
+        inequality_field = None
+        if bounds:
+            def rank(field):
+                ops = set(filtr["operator"][0] for filtr in bounds[field])
+                return (len(ops) < 2,
+                        SESSION_INEQUALITY_PREFERENCE.index(field))
+            inequality_field = min(bounds, key=rank)
+            for field, fs in bounds.iteritems():
+                if field != inequality_field:
+                    residual.extend(fs)
+
+        return (equalities, inequality_field,
+                bounds.get(inequality_field, []), residual)
+
+
+    @endpoints.method(SessionQueryForms, SessionForms,
+            path='querySessions',
+            http_method='POST',
+            name='querySessions')
+    def querySessions(self, request):
+        """Query for sessions on several fields, one page at a time.
+
+        Equality filters and the most selective inequality are run by the
+        datastore; the remaining filters are applied while streaming.
+        """
+        plan, mask = self._fieldMask(SESSION_FORM_PLAN, request.fields)
+        filters = self._formatSessionFilters(request.filters)
+        equalities, inequality_field, inequalities, residual = \
+            self._planSessionQuery(filters)
+        if (not equalities and not request.websafeConferenceKey and
+                inequality_field == 'startTime'):
+            equalities, residual = self._sessionTypesExcept(residual)
+        needed = [filtr["field"] for filtr in residual + inequalities]
+
+        q = self._sessionQuery(request.websafeConferenceKey, equalities,
+                               inequality_field, inequalities)
+        options = self._maskOptions(Session, mask, needed,
+            None if equalities or request.websafeConferenceKey
+            else inequality_field)
+        try:
+            sessions, nextPageToken = self._streamSessions(
+                q, request, options, residual)
+        except datastore_errors.NeedIndexError:
+            # equality filters, with or without an ancestor, are served by
+            # the built-in indexes; do the inequality in Python instead
+            logging.warning('No index for Session query on %s and %s; '
+                            'filtering it while streaming',
+                            sorted(equalities), inequality_field)
+            q = self._sessionQuery(request.websafeConferenceKey, equalities,
+                                   None, [])
+            if not options.get('keys_only'):
+                options = {}
+            sessions, nextPageToken = self._streamSessions(
+                q, request, options, residual + inequalities)
+        return SessionForms(items=plan.copyAll(sessions),
+                            nextPageToken=nextPageToken)
+
+
+    def _sessionTypesExcept(self, residual):
+        """Turn TYPE != filters into an equality on each other type.
+
+        A start time range then runs as one query per remaining type on
+        the (typeOfSession, startTime) index, merged by ndb in startTime
+        and key order, instead of reading the excluded types and skipping
+        them while streaming.  The types come from a distinct projection
+        of the built-in typeOfSession index.
+
+        Returns (equalities, residual); with no such filters, or too many
+        types for one IN filter, the filters stay in residual.
+        """
+        excluded = set(filtr["value"] for filtr in residual
+                       if filtr["field"] == 'typeOfSession'
+                       and filtr["operator"] == "!=")
+        if not excluded:
+            return {}, residual
+        types = [sess.typeOfSession for sess in
+                 Session.query(projection=[Session.typeOfSession],
+                               distinct=True).
+                 fetch(MAX_IN_VALUES + len(excluded) + 1)]
+        types = [t for t in types if t not in excluded]
+        if len(types) > MAX_IN_VALUES:
+            return {}, residual
+        return {'typeOfSession': types}, \
+            [filtr for filtr in residual
+             if filtr["field"] != 'typeOfSession' or filtr["operator"] != "!="]
+
+
+    def _sessionQuery(self, websafeConferenceKey, equalities,
+                      inequality_field, inequalities):
+        """Return the datastore part of a planned session query.
+
+        Filters are built from the Session properties, which convert
+        dates and times to the datastore's types.  An equality with other
+        than one value becomes an IN filter.
+        """
+        q = Session.query()
+        if websafeConferenceKey:
+            q = Session.query(ancestor=ndb.Key(urlsafe=websafeConferenceKey))
+        for field, values in equalities.iteritems():
+            prop = Session._properties[field]
+            q = q.filter(prop == values[0] if len(values) == 1
+                         else prop.IN(values))
+        for filtr in inequalities:
+            q = q.filter(Session._properties[filtr["field"]]._comparison(
+                filtr["operator"], filtr["value"]))
+        if inequality_field:
+            q = q.order(Session._properties[inequality_field])
+        return q.order(Session.key)
+
+
+    def _streamSessions(self, q, request, options, residual):
+        """Return (sessions, nextPageToken) for one page of q, applying the
+        residual filters while streaming.
+        """
+        # stream until the page is full or we've read our share of entities
+        pageSize = self._pageSize(request.pageSize)
+        it = q.iter(batch_size=pageSize, produce_cursors=True,
+            start_cursor=self._pageCursor(request.pageToken), **options)
+        sessions = []
+        scanned = 0
+        for sess in it:
+            scanned += 1
+            if options.get('keys_only'):
+                sess = Session(key=sess)
+            if _matchesFilters(sess, residual):
+                sessions.append(sess)
+            if (len(sessions) >= pageSize or
+                    scanned >= pageSize * QUERY_SCAN_FACTOR):
+                break
+
+        nextPageToken = None
+        if scanned and it.probably_has_next():
+            nextPageToken = it.cursor_after().urlsafe()
+        return sessions, nextPageToken
 
 # - - Wishlist object - - - - - - - - - - - - - - - - - - - - -
 
     def _copyWishlistToForm(self, wishList):
         """Copy relevant fields from Wishlist to WishlistForm."""
-        wf = WishlistForm()
-        for field in wf.all_fields():
-            if hasattr(wishList, field.name):
-                setattr(wf, field.name, getattr(wishList, field.name))
-            elif field.name == "websafeKey":
-                setattr(wf, field.name, wishList.key.urlsafe())
-        
-        wf.check_initialized()
-        return wf
+        return WISHLIST_FORM_PLAN.copy(wishList)
     
 
-    def _createWishlistObject(self, request):
-        """Create Wishlist object, returning WishlistForm/request."""
-        
-        # as usual make sure user is logged in
-        user = self._getAuthUser()
-        user_id = getUserId(user)
-
-        data = {field.name: getattr(request, field.name) for field in request.all_fields()}
-            
-        sess  = ndb.Key(urlsafe=request.websafeSessionKey).get()
+    def _wishlistSessionKeys(self, websafeSessionKeys):
+        """Parse websafe Session keys, raising NotFound for a bad one."""
+        s_keys = []
+        for wssk in websafeSessionKeys:
+            try:
+                s_key = ndb.Key(urlsafe=wssk)
+            except Exception:
+                raise endpoints.NotFoundException(
+                    'invalid websafeSessionKey: %s' % wssk)
+            if s_key.kind() != 'Session':
+                raise endpoints.NotFoundException(
+                    'invalid websafeSessionKey: %s' % wssk)
+            s_keys.append(s_key)
+        return s_keys
+
+
+    def _addToWishlist(self, user_id, s_keys):
+        """Add Sessions to the user's Wishlist, returning the entries.
+
+        Entries are keyed by Session, so the existing entries and the
+        Sessions come back from one get_multi and adding a Session twice
+        just returns its entry again.
+        """
         p_key = ndb.Key(Profile, user_id)
-            
-        q = Wishlist.query(ancestor=p_key). \
-                filter(Wishlist.websafeSessionKey==request.websafeSessionKey).get()
+        w_keys = [Wishlist.keyFor(p_key, s_key) for s_key in s_keys]
+        entities = ndb.get_multi(w_keys + s_keys)
+        wishes, sessions = entities[:len(w_keys)], entities[len(w_keys):]
+
+        new = []
+        for i, s_key in enumerate(s_keys):
+            if wishes[i]:
+                continue
+            sess = sessions[i]
+            if not sess:
+                raise endpoints.NotFoundException(
+                    'No session found with key: %s' % s_key.urlsafe())
+            wishes[i] = Wishlist(key=w_keys[i],
+                                 websafeSessionKey=s_key.urlsafe(),
+                                 sessionName=sess.name,
+                                 userId=user_id,
+                                 duration=sess.duration)
+            new.append(wishes[i])
+        # a concurrent add of the same Session writes the same entity
+        ndb.put_multi(new)
+        return wishes
 
-        if q:
-            raise endpoints.BadRequestException('Session already in Wishlist')
 
-        data['sessionName'] = sess.name
-        data['userId'] = user_id
-        data['duration'] = sess.duration
-            
-        # create Wishlist key with logged in user as the parent
-        w_id = Wishlist.allocate_ids(size=1, parent=p_key)[0]          
-        w_key = ndb.Key(Wishlist, w_id, parent=p_key)
-            
-        data['key'] = w_key
-            
-        # create Wishlist entry
-        wishlist = Wishlist(**data)
-        wishlist.put()
-        
-        return self._copyWishlistToForm(wishlist)
-        
-    def _deleteWishlistObject (self, request):
-        """ Delete Wishlist entry """
-
-        # as usual make sure user is logged in
-        user = self._getAuthUser()
-        
-        user_id = getUserId(user)
-
-        # Find the Wishlist Session record for the user
-        q = Wishlist.query(ancestor=ndb.Key(Profile, user_id)). \
-            filter(Wishlist.websafeSessionKey==request.websafeSessionKey). \
-            get() 
-            
-        # only if it is found should we delete it 
-        if q:
-            q.key.delete()
-        
-        return BooleanMessage(data=True)
-
-    
     @endpoints.method(WISHLIST_GET_REQUEST, WishlistForm, path='wishlist',
             http_method='POST', name='addSessionToWishlist')
     def addSessionToWishlist(self, request):
         """Create new wishlist entry."""
         
-        user = self._getAuthUser()
-        user_id = getUserId(user)
-        
-        p_key = ndb.Key(Profile, user_id)
+        user_id = self._context.userId
         
         #  make sure a Session key is supplied
         if not request.websafeSessionKey:
             raise endpoints.BadRequestException("websafeSessionKey field required")
-        
-        # make sure we can find the Session key.  If it is bogus then 
-        # tell the user it does not exist
-        try:
-            s_key = ndb.Key(urlsafe=request.websafeSessionKey)
-        except Exception, e:
-            raise endpoints.NotFoundException ("invalid websafeSessionKey")
-        
-        sess = s_key.get()
 
-        # make sure we can get the session and if so, then we can do the update
-        if not sess:
-            raise endpoints.NotFoundException(
-                'No session found with key: %s' % request.websafeSessionKey)
-        
-        return self._createWishlistObject(request)
+        s_keys = self._wishlistSessionKeys([request.websafeSessionKey])
+        return self._copyWishlistToForm(self._addToWishlist(user_id, s_keys)[0])
 
 
     @endpoints.method(WISHLIST_GET_REQUEST, BooleanMessage, path='wishlist',
@@ -884,30 +1931,72 @@ class ConferenceApi(remote.Service):
     def deleteSessionToWishlist(self, request):
         """Delete wishlist entry."""
         
-        user = self._getAuthUser()
-        user_id = getUserId(user)
-        
-        p_key = ndb.Key(Profile, user_id)
+        self._getAuthUser()
         
         #  make sure a Session key is supplied
         if not request.websafeSessionKey:
             raise endpoints.BadRequestException("websafeSessionKey field required")
-        
-        # make sure we can find the Session key.  If it is bogus then 
-        # tell the user it does not exist
-        try:
-            s_key = ndb.Key(urlsafe=request.websafeSessionKey)
-        except Exception, e:
-            raise endpoints.NotFoundException ("invalid websafeSessionKey")
 
-        sess = s_key.get()
-        
-        # make sure we can get the session and if so, then we can do the update
-        if not sess:
-            raise endpoints.NotFoundException(
-                'No session found with key: %s' % request.websafeSessionKey)
-        
-        return self._deleteWishlistObject(request)
+        # deleting an entry that isn't there is a no-op
+        s_keys = self._wishlistSessionKeys([request.websafeSessionKey])
+        Wishlist.keyFor(self._context.profileKey, s_keys[0]).delete()
+        return BooleanMessage(data=True)
+
+
+    @endpoints.method(WishlistBatchForm, WishlistForms,
+            path='wishlist/batch',
+            http_method='POST', name='updateWishlist')
+    def updateWishlist(self, request):
+        """Add and remove several wishlist entries at once.
+
+        Returns the entries for the added Sessions.
+        """
+        user_id = self._context.userId
+
+        add_keys = self._wishlistSessionKeys(request.add)
+        remove_keys = self._wishlistSessionKeys(request.remove)
+        if set(add_keys) & set(remove_keys):
+            raise endpoints.BadRequestException(
+                'A session cannot be both added and removed')
+
+        p_key = self._context.profileKey
+        deleted = ndb.delete_multi_async(
+            [Wishlist.keyFor(p_key, s_key) for s_key in remove_keys])
+        wishes = self._addToWishlist(user_id, add_keys)
+        ndb.Future.wait_all(deleted)
+        return WishlistForms(items=WISHLIST_FORM_PLAN.copyAll(wishes))
+
+
+    @staticmethod
+    def _migrateWishlists(cursor=None, batchSize=100):
+        """Re-key a batch of Wishlist entries stored under allocated ids;
+        used by the migrate_wishlists task.
+
+        Returns the cursor to continue from, or None when done.
+        """
+        @ndb.transactional()
+        def migrate(w_key):
+            wish = w_key.get()
+            if not wish:
+                return
+            try:
+                s_key = ndb.Key(urlsafe=wish.websafeSessionKey)
+            except Exception:
+                s_key = None
+            if s_key:
+                new = Wishlist(key=Wishlist.keyFor(w_key.parent(), s_key),
+                               **wish.to_dict())
+                new.websafeSessionKey = s_key.urlsafe()
+                new.put()
+            w_key.delete()
+
+        w_keys, cursor, more = Wishlist.query().fetch_page(batchSize,
+            start_cursor=cursor, keys_only=True)
+        for w_key in w_keys:
+            if not isinstance(w_key.id(), basestring):
+                migrate(w_key)
+        return cursor if more else None
+
     
     @endpoints.method(message_types.VoidMessage, WishlistForms, 
         path='wishlist/sessions',
@@ -915,15 +2004,12 @@ class ConferenceApi(remote.Service):
     def getSessionsInWishlist(self, request):
         """Get all Wishlist entries for the user."""
         
-        user = self._getAuthUser()
-        user_id = getUserId(user)
-        
         # create ancestor query for all key matches for this user
-        wishlist = Wishlist.query(ancestor=ndb.Key(Profile, user_id))
+        wishlist = Wishlist.query(ancestor=self._context.profileKey)
         
         # return set of WishlistForm objects per Wishlist Entry
         return WishlistForms(
-            items=[self._copyWishlistToForm(wish) for wish in wishlist]
+            items=WISHLIST_FORM_PLAN.copyAll(wishlist)
         )
 
 
@@ -934,17 +2020,14 @@ class ConferenceApi(remote.Service):
         """Locate all wishlist entries where the duration is equal or longer
            than the requested duration"""
         
-        user = self._getAuthUser()
-        user_id = getUserId(user)
-        
         # create ancestor query for all key matches for this user
         # and the duration is longer or equal to the specified duration
-        wishls = Wishlist.query(ancestor=ndb.Key(Profile, user_id)). \
+        wishls = Wishlist.query(ancestor=self._context.profileKey). \
                      filter(Wishlist.duration>=request.duration)
 
         # return set of WishlistForm objects per Wishlist
         return WishlistForms(
-            items=[self._copyWishlistToForm(wish) for wish in wishls]
+            items=WISHLIST_FORM_PLAN.copyAll(wishls)
         )
 
 
@@ -952,23 +2035,12 @@ class ConferenceApi(remote.Service):
 
     def _copySpeakerToForm(self, speaker):
         """Copy relevant fields from Speaker to SpeakerForm."""
-        
-        # copy relevant fields from Speaker to SpeakerForm
-        sf = SpeakerForm()
-        for field in sf.all_fields():
-            if hasattr(speaker, field.name):
-                setattr(sf, field.name, getattr(speaker, field.name))
-            elif field.name == "websafeKey":
-                setattr(sf, field.name, speaker.key.urlsafe())
-        
-        sf.check_initialized()
-        return sf
+        return SPEAKER_FORM_PLAN.copy(speaker)
 
     def _createSpeakerObject(self, request):
         """Create Speaker object, returning SpeakerForm/request."""
         
-        user = self._getAuthUser()
-        user_id = getUserId(user)
+        self._getAuthUser()
 
         if not request.name:
             raise endpoints.BadRequestException("Speaker 'name' field required")
@@ -998,8 +2070,7 @@ class ConferenceApi(remote.Service):
     def _updateSpeakerObject(self, request):
         """Update Speaker object, returning SpeakerForm/request."""
         
-        user = self._getAuthUser()
-        user_id = getUserId(user)
+        self._getAuthUser()
 
         # copy SpeakerForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name) for field in request.all_fields()}
@@ -1014,6 +2085,7 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from SpeakerForm to Speaker object
+        name = speaker.name
         for field in request.all_fields():
             data = getattr(request, field.name)
             
@@ -1022,6 +2094,12 @@ class ConferenceApi(remote.Service):
                 setattr(speaker, field.name, data)
         
         speaker.put()
+
+        # copy the new name onto the featured speaker aggregates
+        if speaker.name != name:
+            taskqueue.add(params={'speaker_key': speaker.key.urlsafe()},
+                url='/tasks/update_speaker_name'
+            )
         
         return self._copySpeakerToForm(speaker)
 
@@ -1032,8 +2110,7 @@ class ConferenceApi(remote.Service):
         """Create new speaker."""
         
         # make sure user is authed
-        user = self._getAuthUser()
-        user_id = getUserId(user)
+        self._getAuthUser()
         
         return self._createSpeakerObject(request)
 
@@ -1045,29 +2122,148 @@ class ConferenceApi(remote.Service):
         """Update speaker w/provided fields & return w/updated info."""
         return self._updateSpeakerObject(request)
  
-    @endpoints.method(message_types.VoidMessage, SpeakerForms,
+    @endpoints.method(SPEAKERS_GET_REQUEST, SpeakerForms,
             path='getSpeakers',
             http_method='GET', name='getSpeakers')
     def getSpeakers(self, request):
-        """Return all speakers."""
+        """Return a page of speakers ordered by name.
+
+        With a prefix, only speakers whose normalized name starts with it;
+        either way a single range scan of the nameKey index.
+        """
         
         # make sure user is authed
-        user = self._getAuthUser()
-        user_id = getUserId(user)
+        self._getAuthUser()
 
-        speakers = Speaker.query()
+        q = Speaker.query()
+        prefix = normalizeName(request.prefix)
+        if prefix:
+            q = q.filter(Speaker.nameKey >= prefix,
+                         Speaker.nameKey < prefix + u'\ufffd')
+        speakers, nextPageToken = self._fetchPage(q.order(Speaker.nameKey),
+            request.pageSize, request.pageToken)
         
         return SpeakerForms(
-            items=[self._copySpeakerToForm(speak) for speak in speakers]
+            items=SPEAKER_FORM_PLAN.copyAll(speakers),
+            nextPageToken=nextPageToken
         )
 
-    @endpoints.method(message_types.VoidMessage, StringMessage,
-            path='conference/featured_speaker/get',
+
+    @staticmethod
+    def _reindex(model, cursor=None, batchSize=100):
+        """Rewrite a batch of model's entities so computed properties added
+        since they were written (Speaker.nameKey, Session.dateWeek) are
+        stored; used by the reindex tasks.
+
+        Returns the cursor to continue from, or None when done.
+        """
+        entities, cursor, more = model.query().fetch_page(batchSize,
+            start_cursor=cursor)
+        ndb.put_multi(entities)
+        return cursor if more else None
+
+    @endpoints.method(CONF_VERSION_GET_REQUEST, StringMessage,
+            path='conference/{websafeConferenceKey}/featured_speaker',
             http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data= \
-            memcache.get(MEMCACHE_CONFERENCE_FEATURED_SPEAKERS_KEY) or "")
+        """Return the conference's featured speaker announcement."""
+        c_key = ndb.Key(urlsafe=request.websafeConferenceKey)
+        cache_key = MEMCACHE_FEATURED_SPEAKER_KEY % c_key.urlsafe()
+        announcement, gen = cache.getCurrent(cache_key, cache_key)
+        if announcement is None:
+            # rebuild from the speaker with the most sessions
+            conf = c_key.get()
+            if not conf:
+                raise endpoints.NotFoundException(
+                    'No conference found with key: %s' %
+                    request.websafeConferenceKey)
+            aggregate = self._featuredSpeakerQuery(c_key).get()
+            announcement = ""
+            if aggregate and aggregate.sessionCount > 1:
+                announcement = self._featuredSpeakerText(conf, aggregate)
+            cache.setCurrent(cache_key, gen, announcement)
+        return self._versionedText(request, announcement)
 
 
-api = endpoints.api_server([ConferenceApi]) # register API
+    @staticmethod
+    def _rebuildSpeakerSessions(cursor=None, batchSize=20):
+        """Recompute the SpeakerSessions aggregates of a batch of
+        Conferences from their Sessions; used by the
+        rebuild_speaker_sessions task for sessions written before the
+        aggregates existed.
+
+        Returns the cursor to continue from, or None when done.
+        """
+        c_keys, cursor, more = Conference.query().fetch_page(batchSize,
+            start_cursor=cursor, keys_only=True)
+        for c_key in c_keys:
+            ConferenceApi._rebuildConferenceSpeakers(c_key)
+        return cursor if more else None
+
+
+    @staticmethod
+    def _rebuildConferenceSpeakers(c_key):
+        """Recompute one Conference's SpeakerSessions aggregates."""
+        # Speakers are in other entity groups, so read their names first
+        wssks = set(sess.websafeSpeakerKey for sess in
+                    Session.query(ancestor=c_key) if sess.websafeSpeakerKey)
+        sp_keys = [ndb.Key(urlsafe=wssk) for wssk in wssks]
+        names = dict((sp_key.urlsafe(), speaker.name) for sp_key, speaker
+                     in zip(sp_keys, ndb.get_multi(sp_keys)) if speaker)
+
+        @ndb.transactional()
+        def txn():
+            old = dict((aggregate.key.id(), aggregate) for aggregate in
+                       SpeakerSessions.query(ancestor=c_key))
+            new = {}
+            for sess in Session.query(ancestor=c_key).order(Session.key):
+                wssk = sess.websafeSpeakerKey
+                if not wssk:
+                    continue
+                if wssk not in new:
+                    new[wssk] = SpeakerSessions(
+                        key=ndb.Key(SpeakerSessions, wssk, parent=c_key),
+                        speakerName=names.get(wssk,
+                            getattr(old.get(wssk), 'speakerName', None)))
+                new[wssk].sessionNames.append(sess.name)
+                new[wssk].sessionCount += 1
+            ndb.put_multi(new.values())
+            ndb.delete_multi([aggregate.key for wssk, aggregate
+                              in old.iteritems() if wssk not in new])
+
+        txn()
+        cache.bump(MEMCACHE_FEATURED_SPEAKER_KEY % c_key.urlsafe())
+
+
+    @staticmethod
+    def _updateSpeakerName(sp_key, cursor=None, batchSize=100):
+        """Copy a Speaker's name onto the SpeakerSessions aggregates of one
+        batch of its Sessions' Conferences; used by the
+        update_speaker_name task.
+
+        Returns the cursor to continue from, or None when done.
+        """
+        speaker = sp_key.get()
+        if not speaker:
+            return None
+        wssk = sp_key.urlsafe()
+        s_keys, cursor, more = Session.query(
+            Session.websafeSpeakerKey == wssk).order(Session.key). \
+            fetch_page(batchSize, start_cursor=cursor, keys_only=True)
+
+        @ndb.transactional()
+        def txn(a_key):
+            aggregate = a_key.get()
+            if aggregate and aggregate.speakerName != speaker.name:
+                aggregate.speakerName = speaker.name
+                aggregate.put()
+                return True
+            return False
+
+        for c_key in set(s_key.parent() for s_key in s_keys):
+            if txn(ndb.Key(SpeakerSessions, wssk, parent=c_key)):
+                cache.bump(MEMCACHE_FEATURED_SPEAKER_KEY % c_key.urlsafe())
+        return cursor if more else None
+
+
+api = stats.instrument(endpoints.api_server([ConferenceApi])) # register API
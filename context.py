@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+"""context.py
+
+Per-request state shared by the ConferenceApi helpers.
+
+The endpoints user, the user id derived from it and the user's Profile
+are each resolved at most once per request, however many helpers ask.
+
+"""
+
+import os
+
+import endpoints
+
+from google.appengine.api import users
+from google.appengine.ext import ndb
+
+from models import Profile
+from models import TeeShirtSize
+from utils import getUserId
+import settings
+
+_UNSET = object()
+
+
+def _stubUser():
+    """Return the user named by the stub auth header, or None.
+
+    Only honoured on the development server with settings.ALLOW_STUB_AUTH
+    turned on, for load testing without real OAuth tokens (see
+    loadtest.py).
+    """
+    if not settings.ALLOW_STUB_AUTH:
+        return None
+    if not os.environ.get('SERVER_SOFTWARE', '').startswith('Development'):
+        return None
+    header = 'HTTP_' + settings.STUB_AUTH_HEADER.upper().replace('-', '_')
+    email = os.environ.get(header)
+    return users.User(email, 'gmail.com') if email else None
+
+
+class RequestContext(object):
+    """Lazily resolved identity and Profile of the calling user."""
+
+    def __init__(self):
+        self._user = None
+        self._userId = None
+        self._profile = _UNSET
+
+    @property
+    def user(self):
+        """The endpoints user; raises Unauthorized if not logged in."""
+        if self._user is None:
+            self._user = _stubUser() or endpoints.get_current_user()
+            if not self._user:
+                raise endpoints.UnauthorizedException('Authorization required')
+        return self._user
+
+    @property
+    def userId(self):
+        if self._userId is None:
+            self._userId = getUserId(self.user, settings.USER_ID_TYPE)
+        return self._userId
+
+    @property
+    def profileKey(self):
+        return ndb.Key(Profile, self.userId)
+
+    @property
+    def profile(self):
+        """The user's Profile, created on first use if non-existent."""
+        if self._profile is _UNSET:
+            profile = self.profileKey.get()
+            if not profile:
+                profile = Profile(
+                    key = self.profileKey,
+                    displayName = self.user.nickname(),
+                    mainEmail= self.user.email(),
+                    teeShirtSize = str(TeeShirtSize.NOT_SPECIFIED),
+                )
+                profile.put()
+            self._profile = profile
+        return self._profile
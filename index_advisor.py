@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""index_advisor.py
+
+Check the Conference indexes in index.yaml against the queries the API
+can run.
+
+    python index_advisor.py --sdk ~/google_appengine
+
+Every query shape queryConferences can produce (each subset of FIELDS
+with an equality filter, plus at most one inequality field, filtered
+with a range or with !=) is ordered with ConferenceApi._conferenceOrders,
+exactly as _getQuery does, and mapped to the index it needs.  An
+inequality that ConferenceApi._streamedFilters applies while streaming
+is left out of the datastore query.  ndb runs a != filter as a < query
+and a > query merged on the sort orders, so such a shape needs the
+index of its range shape, and gets cursors only because every order
+ends in the key.  That is none when the built-in
+single-property indexes serve it, alone or zigzag merge-joined, and one
+composite index otherwise.  The other Conference queries are listed in
+OTHER_SHAPES.  The report lists each shape with its index, then the
+composite indexes index.yaml lacks, the Conference indexes no shape
+uses and indexes that duplicate another.  Every composite index is
+written on every conference write and seat count change, so unused
+ones are pure cost; remove them from index.yaml and vacuum them.
+
+"""
+
+import argparse
+import itertools
+import os
+import sys
+
+from benchmark import setupPath
+
+INDEX_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'index.yaml')
+CHECKED_KINDS = ('Conference',)
+
+# (name, kind, equality fields, inequality field, sort orders) of the
+# Conference queries outside queryConferences; projected properties
+# follow the inequality in the index just like sort orders.  The nearly
+# sold out cron now walks conferences by key, so there are none.
+OTHER_SHAPES = []
+
+
+class Shape(object):
+    """One query shape and the composite index it needs, if any."""
+
+    def __init__(self, name, kind, equalities, inequality, orders,
+                 merged=False, streamed=False):
+        self.name = name
+        self.kind = kind
+        self.equalities = frozenset(equalities)
+        self.inequality = inequality
+        self.orders = tuple(orders)
+        self.merged = merged
+        self.streamed = streamed
+        self.index = requiredIndex(self.equalities, inequality, orders)
+
+    def describe(self):
+        if self.index is None:
+            if len(self.equalities) > 1 and not self.inequality:
+                text = 'built-in (merge join)'
+            else:
+                text = 'built-in'
+        else:
+            text = 'composite (%s)' % ', '.join(sorted(self.index[0]) +
+                                                list(self.index[1]))
+        if self.merged:
+            text += ', 2 queries merged'
+        if self.streamed:
+            text += ', inequality while streaming'
+        return text
+
+
+def requiredIndex(equalities, inequality, orders):
+    """Return (equality fields, ordered fields) of the composite index a
+    query needs, or None if the built-in indexes serve it.
+    """
+    orders = list(orders)
+    if inequality and orders[:1] != [inequality]:
+        orders.insert(0, inequality)
+    # ascending key order is how every index ends anyway
+    if orders and orders[-1] == '__key__':
+        orders.pop()
+    if not orders:
+        return None
+    if not equalities and len(orders) == 1:
+        return None
+    return (frozenset(equalities), tuple(orders))
+
+
+def serves(index, shape):
+    """True if the index.yaml index can run a query of this shape."""
+    if shape.index is None or index.kind != shape.kind or index.ancestor:
+        return False
+    if any(prop.direction not in (None, 'asc') for prop in index.properties):
+        return False
+    names = [prop.name for prop in index.properties]
+    equalities, orders = shape.index
+    split = len(equalities)
+    return (frozenset(names[:split]) == equalities and
+            tuple(names[split:]) == orders)
+
+
+def conferenceShapes():
+    """Return a Shape for each query queryConferences can run."""
+    from conference import ConferenceApi
+    from conference import FIELDS
+
+    fields = sorted(FIELDS.values())
+    inequalities = [(None, None)] + [(field, operator) for field in fields
+                                     for operator in ('>', '!=')]
+    shapes = []
+    for inequality, operator in inequalities:
+        others = [field for field in fields if field != inequality]
+        for size in range(len(others) + 1):
+            for equalities in itertools.combinations(others, size):
+                filters = [{"field": field, "operator": "="}
+                           for field in equalities]
+                if inequality:
+                    filters.append({"field": inequality,
+                                    "operator": operator})
+                orders = ConferenceApi._conferenceOrders(inequality, filters)
+                streamed = bool(ConferenceApi._streamedFilters(inequality,
+                                                               filters))
+                name = ', '.join(['%s=' % field for field in equalities] +
+                                 ['%s%s' % (inequality, operator)] *
+                                 bool(inequality))
+                shapes.append(Shape(name or '(no filters)', 'Conference',
+                                    equalities,
+                                    None if streamed else inequality,
+                                    orders,
+                                    merged=operator == '!=' and not streamed,
+                                    streamed=streamed))
+    return shapes
+
+
+def indexYaml(kind, equalities, orders):
+    lines = ['- kind: %s' % kind, '  properties:']
+    for name in sorted(equalities) + list(orders):
+        lines.append('  - name: %s' % name)
+    return '\n'.join(lines)
+
+
+def report(shapes, indexes):
+    print 'queryConferences and other Conference query shapes:'
+    for shape in shapes:
+        print '  %-40s %s' % (shape.name, shape.describe())
+    needed = [shape for shape in shapes if shape.index is not None]
+    print '%d shapes, %d need a composite index' % (len(shapes), len(needed))
+
+    missing = []
+    for shape in needed:
+        if not any(serves(index, shape) for index in indexes) and \
+                shape.index not in missing:
+            missing.append(shape.index)
+    print
+    print 'composite indexes missing from index.yaml: %d' % len(missing)
+    for equalities, orders in missing:
+        print indexYaml('Conference', equalities, orders)
+        print
+
+    checked = [index for index in indexes if index.kind in CHECKED_KINDS]
+    unused = [index for index in checked
+              if not any(serves(index, shape) for shape in shapes)]
+    print 'Conference indexes no query uses: %d' % len(unused)
+    for index in unused:
+        print '  (%s)' % ', '.join(prop.name for prop in index.properties)
+
+    redundant = []
+    for i, index in enumerate(checked):
+        used = set(shape.name for shape in shapes if serves(index, shape))
+        for earlier in checked[:i]:
+            if used and used <= set(shape.name for shape in shapes
+                                    if serves(earlier, shape)):
+                redundant.append(index)
+                break
+    print 'Conference indexes duplicating an earlier one: %d' % len(redundant)
+    for index in redundant:
+        print '  (%s)' % ', '.join(prop.name for prop in index.properties)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--sdk', default=os.environ.get('APPENGINE_SDK'),
+                        help='path to the App Engine Python SDK')
+    parser.add_argument('--index', default=INDEX_FILE,
+                        help='index.yaml to check, default %(default)s')
+    args = parser.parse_args(argv)
+    if not args.sdk:
+        parser.error('--sdk or APPENGINE_SDK is required')
+
+    setupPath(args.sdk)
+    from google.appengine.datastore import datastore_index
+
+    with open(args.index) as f:
+        definitions = datastore_index.ParseIndexDefinitions(f)
+    indexes = (definitions and definitions.indexes) or []
+    shapes = conferenceShapes() + [Shape(*shape) for shape in OTHER_SHAPES]
+    report(shapes, indexes)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""loadtest.py
+
+Drive a local dev_appserver with many concurrent simulated users.
+
+    dev_appserver.py --env_var ALLOW_STUB_AUTH=1 .
+    python loadtest.py --users 50 --duration 60 --seats 20
+
+Users authenticate with the development-only stub auth header (see
+settings.STUB_AUTH_HEADER), so no OAuth tokens are needed.  The server
+only honours it when started with ALLOW_STUB_AUTH=1 as above.  A setup
+phase creates a few conferences with --seats seats each, plus their
+sessions, through the API.  Then every user thread replays a weighted
+mix of calls (--mix) until --duration runs out.
+
+The report gives overall throughput and, per call, p50/p90/p99 latency
+and outcomes.  Outcomes separate sold out and already-registered
+conflicts (409), datastore contention and other server errors.  Only a
+503 whose message names TransactionFailedError, which registration and
+conference updates return when their transaction keeps colliding,
+counts as contention; check the dev_appserver log for the rest.
+
+"""
+
+import argparse
+import json
+import random
+import threading
+import time
+import urllib
+import urllib2
+from collections import defaultdict
+from datetime import date
+from datetime import timedelta
+
+import settings
+
+DEFAULT_MIX = ('queryConferences=35,getConference=30,registerForConference=15,'
+               'addSessionToWishlist=10,createSession=5,updateConference=5')
+API_PATH = '/_ah/api/conference/v1/'
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Client(object):
+    """Calls the conference API as one user."""
+
+    def __init__(self, host, email):
+        self.root = host.rstrip('/') + API_PATH
+        self.email = email
+
+    def call(self, method, path, body=None, **params):
+        """Return (status, decoded JSON body or error text)."""
+        url = self.root + path
+        if params:
+            url += '?' + urllib.urlencode(params)
+        data = json.dumps(body) if body is not None else None
+        if data is None and method in ('POST', 'PUT'):
+            data = '{}'
+        req = urllib2.Request(url, data, {settings.STUB_AUTH_HEADER: self.email,
+                                          'Content-Type': 'application/json'})
+        req.get_method = lambda: method
+        try:
+            resp = urllib2.urlopen(req)
+            content = resp.read()
+            return resp.getcode(), json.loads(content) if content else {}
+        except urllib2.HTTPError, e:
+            content = e.read()
+            try:
+                message = json.loads(content)['error']['message']
+            except (ValueError, KeyError, TypeError):
+                message = content[:200]
+            return e.code, message
+        except urllib2.URLError, e:
+            return 0, str(e.reason)
+
+
+class LoadTest(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.mix = []
+        for item in args.mix.split(','):
+            name, weight = item.split('=')
+            self.mix.append((name.strip(), int(weight)))
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.outcomes = defaultdict(lambda: defaultdict(int))
+
+    def setUp(self):
+        """Create the conferences, speaker and sessions the mix works on."""
+        organiser = Client(self.args.host, 'loadtest-organiser@example.com')
+        organiser.call('POST', 'profile', {'displayName': 'Organiser'})
+        status, speaker = organiser.call('POST', 'speaker',
+            {'name': 'Load Test Speaker', 'email': 'speaker@example.com'})
+        self.check(status, speaker, 'createSpeaker')
+        self.speaker = speaker['websafeKey']
+
+        self.conferences = []
+        self.sessions = []
+        start = date.today() + timedelta(days=30)
+        for i in range(self.args.conferences):
+            status, conf = organiser.call('POST', 'conference', {
+                'name': 'Load test conference %d' % i, 'city': 'London',
+                'topics': ['Web Technologies'],
+                'startDate': start.isoformat(),
+                'maxAttendees': self.args.seats})
+            self.check(status, conf, 'createConference')
+            self.conferences.append(conf['websafeKey'])
+            status, sessions = organiser.call('POST', 'sessions', {'items': [
+                {'name': 'Session %d' % j, 'confWebsafeKey': conf['websafeKey'],
+                 'websafeSpeakerKey': self.speaker, 'duration': 60,
+                 'typeOfSession': 'Lecture', 'date': start.isoformat(),
+                 'startTime': '%02d:00' % (9 + j)} for j in range(5)]})
+            self.check(status, sessions, 'createSessions')
+            self.sessions.extend(s['websafeKey'] for s in sessions['items'])
+        self.organiser = organiser
+
+    def check(self, status, body, what):
+        if status != 200:
+            raise SystemExit('setup %s failed: %s %s' % (what, status, body))
+
+    def pick(self, rnd):
+        total = sum(weight for name, weight in self.mix)
+        r = rnd.uniform(0, total)
+        for name, weight in self.mix:
+            r -= weight
+            if r <= 0:
+                return name
+        return self.mix[-1][0]
+
+    def operation(self, name, state, rnd):
+        """Return (label, method, path, body, params) for one call."""
+        wsck = rnd.choice(self.conferences)
+        if name == 'queryConferences':
+            return name, 'POST', 'queryConferences', {'filters': []}, {}
+        if name == 'getConference':
+            return name, 'GET', 'conference/%s' % wsck, None, {}
+        if name == 'registerForConference':
+            # alternate, so users keep competing for the same seats
+            if wsck in state['registered']:
+                state['registered'].discard(wsck)
+                return ('unregisterFromConference', 'DELETE',
+                        'conference/%s' % wsck, None, {})
+            state['registered'].add(wsck)
+            return name, 'POST', 'conference/%s' % wsck, None, {}
+        if name == 'addSessionToWishlist':
+            return name, 'POST', 'wishlist', None, {
+                'websafeSessionKey': rnd.choice(self.sessions)}
+        if name == 'createSession':
+            return name, 'POST', 'session', {
+                'name': 'Load session %d' % rnd.randrange(10 ** 9),
+                'confWebsafeKey': wsck, 'websafeSpeakerKey': self.speaker,
+                'duration': 30, 'typeOfSession': 'Panel',
+                'startTime': '18:00'}, {}
+        if name == 'updateConference':
+            return name, 'PUT', 'conference/%s' % wsck, {
+                'description': 'Updated %d' % rnd.randrange(10 ** 9)}, {}
+        raise SystemExit('unknown call in --mix: %s' % name)
+
+    def outcome(self, status, body):
+        if status == 200:
+            return 'ok'
+        if status == 409:
+            if 'no seats' in unicode(body):
+                return 'soldOut'
+            return 'conflict'
+        if status == 503 and 'TransactionFailedError' in unicode(body):
+            return 'contention'
+        if status >= 500:
+            return 'serverError'
+        if status == 0:
+            return 'connectionError'
+        return 'http%d' % status
+
+    def user(self, i, deadline):
+        rnd = random.Random(self.args.seed + i)
+        client = Client(self.args.host, 'loadtest-user%d@example.com' % i)
+        state = {'registered': set()}
+        while time.time() < deadline:
+            name = self.pick(rnd)
+            caller = client
+            # only the organiser may update or add sessions to its conferences
+            if name in ('createSession', 'updateConference'):
+                caller = self.organiser
+            label, method, path, body, params = \
+                self.operation(name, state, rnd)
+            start = time.time()
+            status, result = caller.call(method, path, body, **params)
+            elapsed = (time.time() - start) * 1000
+            with self.lock:
+                self.samples[label].append(elapsed)
+                self.outcomes[label][self.outcome(status, result)] += 1
+            if label == 'registerForConference' and status != 200:
+                state['registered'].discard(path.split('/')[-1])
+            if label == 'unregisterFromConference' and status != 200:
+                state['registered'].add(path.split('/')[-1])
+
+    def run(self):
+        self.setUp()
+        deadline = time.time() + self.args.duration
+        threads = [threading.Thread(target=self.user, args=(i, deadline))
+                   for i in range(self.args.users)]
+        start = time.time()
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.time() - start
+
+    def report(self, elapsed):
+        total = sum(len(samples) for samples in self.samples.values())
+        print 'users %d, %.1fs, %d calls, %.1f calls/s' % (
+            self.args.users, elapsed, total, total / elapsed)
+        print '%-26s%8s%10s%10s%10s  %s' % ('call', 'calls', 'p50 ms',
+                                          'p90 ms', 'p99 ms', 'outcomes')
+        for label in sorted(self.samples):
+            samples = self.samples[label]
+            outcomes = ', '.join('%s %d' % item for item in
+                                 sorted(self.outcomes[label].items()))
+            print '%-26s%8d%10.1f%10.1f%10.1f  %s' % (label, len(samples),
+                percentile(samples, 50), percentile(samples, 90),
+                percentile(samples, 99), outcomes)
+        print 'transaction contention: %d, other server errors: %d' % tuple(
+            sum(outcomes.get(outcome, 0) for outcomes in self.outcomes.values())
+            for outcome in ('contention', 'serverError'))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--host', default='http://localhost:8080')
+    parser.add_argument('--users', type=int, default=20,
+                        help='concurrent simulated users')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds to run the mix for')
+    parser.add_argument('--conferences', type=int, default=3)
+    parser.add_argument('--seats', type=int, default=10,
+                        help='seats per conference; small means contention')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='call=weight list, default %(default)s')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    test = LoadTest(args)
+    test.report(test.run())
+
+
+if __name__ == '__main__':
+    main()
@@ -12,24 +12,39 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+
 import webapp2
 from google.appengine.api import app_identity
 from google.appengine.api import mail
-from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 
-from models import Session
-
 from conference import ConferenceApi
+from models import Session
+from models import Speaker
+import bulk
+import seats
+import stats
 
-MEMCACHE_CONFERENCE_FEATURED_SPEAKERS_KEY = "CONFERENCE_FEATURED_SPEAKERS"
-FEATURED_SPEAKERS_TPL = ('Featured Speaker for conference %s is %s! '
-                         'Sessions include: %s')
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
     def get(self):
-        """Set Announcement in Memcache."""
-        ConferenceApi._cacheAnnouncement()
+        """Start reconciling the nearly sold out announcement."""
+        taskqueue.add(url='/tasks/reconcile_nearly_sold_out')
+        self.response.set_status(202)
+
+
+class ReconcileNearlySoldOutHandler(webapp2.RequestHandler):
+    def post(self):
+        """Reconcile one batch of Conferences, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        cursor = ConferenceApi._cacheAnnouncement(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()},
+                url='/tasks/reconcile_nearly_sold_out')
         self.response.set_status(204)
 
 
@@ -47,42 +62,160 @@ class SendConfirmationEmailHandler(webapp2.RequestHandler):
         )
 
 
-class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
+class RollupSeatsHandler(webapp2.RequestHandler):
     def post(self):
-        "Set Memcache Key for Featured Speaker"
-        
+        """Roll up a Conference's seat shards into seatsAvailable."""
         c_key = ndb.Key(urlsafe=self.request.get('conference_key'))
-            
-        num_speaker_sessions = Session.query(ancestor=c_key). \
-            filter(Session.websafeSpeakerKey==self.request.get('speaker_key')). \
-            count(limit=None)
-        
-        # A num_speaker_sessions count greater than 1 will update the
-        # MEMCACHE 
-        if num_speaker_sessions > 1:
-            
-            # This query...all sessions for the conference where this
-            # speaker is speaking
-            speaker_sessions = Session.query(ancestor=c_key). \
-                filter(Session.websafeSpeakerKey==self.request.get('speaker_key')). \
-                fetch()
-            
-            conf = c_key.get()
-            
-            sp_key = ndb.Key(urlsafe=self.request.get('speaker_key'))
-            speaker = sp_key.get()        
-            
-            speaker_announcement = FEATURED_SPEAKERS_TPL % (
-                conf.name, speaker.name, ', '.join(speaker_session.name for speaker_session in speaker_sessions))
-        
-
-            memcache.set(MEMCACHE_CONFERENCE_FEATURED_SPEAKERS_KEY, speaker_announcement)
-        
+        if seats.rollup(c_key):
+            ConferenceApi._conferencesChanged(c_key)
+        self.response.set_status(204)
+
+
+class MigrateRegistrationsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start moving Profile registration lists to Registrations."""
+        taskqueue.add(url='/tasks/migrate_registrations')
+        self.response.set_status(202)
+
+    def post(self):
+        """Migrate one batch of Profiles, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        cursor = ConferenceApi._migrateRegistrations(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()},
+                url='/tasks/migrate_registrations')
+        self.response.set_status(204)
+
+
+class MigrateWishlistsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start re-keying Wishlist entries by Session."""
+        taskqueue.add(url='/tasks/migrate_wishlists')
+        self.response.set_status(202)
+
+    def post(self):
+        """Migrate one batch of Wishlist entries, then chain the next."""
+        cursor = self.request.get('cursor')
+        cursor = ConferenceApi._migrateWishlists(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()},
+                url='/tasks/migrate_wishlists')
+        self.response.set_status(204)
+
+
+class ReindexHandler(webapp2.RequestHandler):
+    MODELS = {'speakers': Speaker, 'sessions': Session}
+
+    def get(self, kind):
+        """Start storing computed properties on every entity of kind."""
+        if kind not in self.MODELS:
+            self.abort(404)
+        taskqueue.add(url='/tasks/reindex_%s' % kind)
+        self.response.set_status(202)
+
+    def post(self, kind):
+        """Reindex one batch of entities, then chain the next."""
+        if kind not in self.MODELS:
+            self.abort(404)
+        cursor = self.request.get('cursor')
+        cursor = ConferenceApi._reindex(self.MODELS[kind],
+            Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()},
+                url='/tasks/reindex_%s' % kind)
+        self.response.set_status(204)
+
+
+class UpdateOrganizerNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy an organiser's displayName onto their Conferences."""
+        p_key = ndb.Key(urlsafe=self.request.get('profile_key'))
+        cursor = self.request.get('cursor')
+        cursor = ConferenceApi._updateOrganizerName(p_key,
+            Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'profile_key': p_key.urlsafe(),
+                'cursor': cursor.urlsafe()},
+                url='/tasks/update_organizer_name')
+        self.response.set_status(204)
+
+
+class RebuildSpeakerSessionsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start recomputing every Conference's featured speaker aggregates."""
+        taskqueue.add(url='/tasks/rebuild_speaker_sessions')
+        self.response.set_status(202)
+
+    def post(self):
+        """Rebuild one batch of Conferences, then chain the next batch."""
+        cursor = self.request.get('cursor')
+        cursor = ConferenceApi._rebuildSpeakerSessions(
+            Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'cursor': cursor.urlsafe()},
+                url='/tasks/rebuild_speaker_sessions')
+        self.response.set_status(204)
+
+
+class UpdateSpeakerNameHandler(webapp2.RequestHandler):
+    def post(self):
+        """Copy a Speaker's name onto its featured speaker aggregates."""
+        sp_key = ndb.Key(urlsafe=self.request.get('speaker_key'))
+        cursor = self.request.get('cursor')
+        cursor = ConferenceApi._updateSpeakerName(sp_key,
+            Cursor(urlsafe=cursor) if cursor else None)
+        if cursor:
+            taskqueue.add(params={'speaker_key': sp_key.urlsafe(),
+                'cursor': cursor.urlsafe()},
+                url='/tasks/update_speaker_name')
+        self.response.set_status(204)
+
+
+class BulkHandler(webapp2.RequestHandler):
+    def get(self):
+        """Start a bulk import or export job."""
+        try:
+            job = bulk.start(self.request.get('operation'),
+                             self.request.get('kind'),
+                             self.request.get('path'),
+                             self.request.get('format') or 'jsonl')
+        except ValueError, e:
+            self.abort(400, detail=str(e))
+        self.response.set_status(202)
+        self.response.write('bulk job %d started' % job.key.id())
+
+    def post(self):
+        """Run the next step of a bulk job."""
+        bulk.run(int(self.request.get('job')), int(self.request.get('step')))
+        self.response.set_status(204)
+
+
+class StatsHandler(webapp2.RequestHandler):
+    def get(self):
+        """Return the per-method stats aggregates as JSON."""
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps(stats.snapshot(), indent=2,
+                                       sort_keys=True))
+
+    def delete(self):
+        """Reset the stats aggregates."""
+        stats.reset()
         self.response.set_status(204)
 
 
-app = webapp2.WSGIApplication([
+app = stats.instrument(webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
-    ('/tasks/set_featured_speaker', SetFeaturedSpeakerHandler),
-], debug=True)
+    ('/tasks/rollup_seats', RollupSeatsHandler),
+    ('/tasks/reconcile_nearly_sold_out', ReconcileNearlySoldOutHandler),
+    ('/tasks/migrate_registrations', MigrateRegistrationsHandler),
+    ('/tasks/migrate_wishlists', MigrateWishlistsHandler),
+    (r'/tasks/reindex_(\w+)', ReindexHandler),
+    ('/tasks/update_organizer_name', UpdateOrganizerNameHandler),
+    ('/tasks/rebuild_speaker_sessions', RebuildSpeakerSessionsHandler),
+    ('/tasks/update_speaker_name', UpdateSpeakerNameHandler),
+    ('/tasks/bulk', BulkHandler),
+    ('/admin/stats', StatsHandler),
+], debug=True))
@@ -14,6 +14,7 @@ add session, speaker and wishlist forms by David D 2016 Jan 26
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 import httplib
+from datetime import timedelta
 import endpoints
 from protorpc import messages
 from google.appengine.ext import ndb
@@ -22,13 +23,31 @@ class ConflictException(endpoints.ServiceException):
     """ConflictException -- exception mapped to HTTP 409 response"""
     http_status = httplib.CONFLICT
 
+class ContentionException(endpoints.ServiceException):
+    """ContentionException -- exception mapped to HTTP 503 response"""
+    http_status = httplib.SERVICE_UNAVAILABLE
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
+    # legacy registrations; see Registration and _migrateRegistrations
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
 
+class Registration(ndb.Model):
+    """Registration -- a user's registration for a Conference
+
+    Keyed by the Conference's websafe key under the user's Profile, so
+    membership checks are a key get.
+    """
+    conferenceKey = ndb.KeyProperty(kind='Conference', required=True)
+
+    @classmethod
+    def keyFor(cls, p_key, c_key):
+        """Return the Registration key for Profile p_key and Conference c_key."""
+        return ndb.Key(cls, c_key.urlsafe(), parent=p_key)
+
 class ProfileMiniForm(messages.Message):
     """ProfileMiniForm -- update Profile form message"""
     displayName = messages.StringField(1)
@@ -40,10 +59,19 @@ class ProfileForm(messages.Message):
     mainEmail = messages.StringField(2)
     teeShirtSize = messages.EnumField('TeeShirtSize', 3)
     conferenceKeysToAttend = messages.StringField(4, repeated=True)
+    version = messages.StringField(5)
+    notModified = messages.BooleanField(6)
+
+class ProfileForms(messages.Message):
+    """ProfileForms -- multiple Profile outbound form message"""
+    items = messages.MessageField(ProfileForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
+    version = messages.StringField(2)
+    notModified = messages.BooleanField(3)
 
 class BooleanMessage(messages.Message):
     """BooleanMessage-- outbound Boolean value message"""
@@ -54,6 +82,8 @@ class Conference(ndb.Model):
     name            = ndb.StringProperty(required=True)
     description     = ndb.StringProperty()
     organizerUserId = ndb.StringProperty()
+    # copy of the organiser's Profile.displayName; see _updateOrganizerName
+    organizerDisplayName = ndb.StringProperty(indexed=False)
     topics          = ndb.StringProperty(repeated=True)
     city            = ndb.StringProperty()
     startDate       = ndb.DateProperty()
@@ -61,6 +91,18 @@ class Conference(ndb.Model):
     endDate         = ndb.DateProperty()
     maxAttendees    = ndb.IntegerProperty()
     seatsAvailable  = ndb.IntegerProperty()
+    seatShards      = ndb.IntegerProperty(default=0, indexed=False)
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a Conference's available seats"""
+    seatsAvailable  = ndb.IntegerProperty(default=0, indexed=False)
+
+class NearlySoldOut(ndb.Model):
+    """NearlySoldOut -- index of conferences with only a few seats left
+
+    Keyed by the Conference's websafe key.
+    """
+    name            = ndb.StringProperty(indexed=False)
 
 class ConferenceForm(messages.Message):
     """ConferenceForm -- Conference outbound form message"""
@@ -76,10 +118,13 @@ class ConferenceForm(messages.Message):
     endDate         = messages.StringField(10) #DateTimeField()
     websafeKey      = messages.StringField(11)
     organizerDisplayName = messages.StringField(12)
+    version         = messages.StringField(13)
+    notModified     = messages.BooleanField(14)
 
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class TeeShirtSize(messages.Enum):
     """TeeShirtSize -- t-shirt size enumeration value"""
@@ -108,6 +153,16 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(3)
+    fields = messages.StringField(4, repeated=True)
+
+def weekOf(date):
+    """Return the week bucket for date: its Monday as YYYY-MM-DD."""
+    if date is None:
+        return None
+    return (date - timedelta(days=date.weekday())).isoformat()
+
 
 class Session(ndb.Model):
     """Session -- Session object"""
@@ -118,6 +173,8 @@ class Session(ndb.Model):
     typeOfSession     = ndb.StringProperty()
     date              = ndb.DateProperty()
     startTime         = ndb.TimeProperty()
+    # week bucket, so "what's on that week" is an equality filter
+    dateWeek          = ndb.ComputedProperty(lambda self: weekOf(self.date))
     
 class SessionForm(messages.Message):
     """SessionForm -- Session outbound form message"""
@@ -134,14 +191,38 @@ class SessionForm(messages.Message):
 class SessionForms(messages.Message):
     """SessionForms -- multiple Session outbound form message"""
     items = messages.MessageField(SessionForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
+    version = messages.StringField(3)
+    notModified = messages.BooleanField(4)
+
+class SessionQueryForm(messages.Message):
+    """SessionQueryForm -- Session query inbound form message"""
+    field = messages.StringField(1)
+    operator = messages.StringField(2)
+    value = messages.StringField(3)
+
+class SessionQueryForms(messages.Message):
+    """SessionQueryForms -- multiple SessionQueryForm inbound form message"""
+    filters = messages.MessageField(SessionQueryForm, 1, repeated=True)
+    websafeConferenceKey = messages.StringField(2)
+    pageSize = messages.IntegerField(3, variant=messages.Variant.INT32)
+    pageToken = messages.StringField(4)
+    fields = messages.StringField(5, repeated=True)
 
 class Wishlist(ndb.Model):
-    """Wishlist -- Wishlist object"""
+    """Wishlist -- Wishlist object
+
+    Child of the user's Profile, keyed by the Session's websafe key.
+    """
     websafeSessionKey   = ndb.StringProperty()
     sessionName         = ndb.StringProperty()
     userId              = ndb.StringProperty()
     duration            = ndb.IntegerProperty()
-    
+
+    @classmethod
+    def keyFor(cls, p_key, s_key):
+        """Return the Wishlist key for Profile p_key and Session s_key."""
+        return ndb.Key(cls, s_key.urlsafe(), parent=p_key)
 
     
 class WishlistForm(messages.Message):
@@ -158,11 +239,34 @@ class WishlistForms(messages.Message):
     items = messages.MessageField(WishlistForm, 1, repeated=True)
 
 
+class WishlistBatchForm(messages.Message):
+    """WishlistBatchForm -- Sessions to add to and remove from a Wishlist"""
+    add    = messages.StringField(1, repeated=True)
+    remove = messages.StringField(2, repeated=True)
+
+
+def normalizeName(name):
+    """Return name folded for case and spacing insensitive matching."""
+    return u' '.join((name or u'').lower().split())
+
+
 class Speaker(ndb.Model):
     """Speaker -- Speaker object"""
     name  = ndb.StringProperty(required=True)
     email = ndb.StringProperty(required=True)
-    sessionKeysToSpeak = ndb.StringProperty(repeated=True)
+    # speaker directory order and typeahead prefix index
+    nameKey = ndb.ComputedProperty(lambda self: normalizeName(self.name))
+
+
+class SpeakerSessions(ndb.Model):
+    """SpeakerSessions -- a Speaker's sessions at one Conference
+
+    Child of the Conference, keyed by the Speaker's websafe key; kept up
+    to date in the same transaction that creates the sessions.
+    """
+    speakerName  = ndb.StringProperty(indexed=False)
+    sessionNames = ndb.StringProperty(repeated=True, indexed=False)
+    sessionCount = ndb.IntegerProperty(default=0)
 
 
 class SpeakerForm(messages.Message):
@@ -170,13 +274,36 @@ class SpeakerForm(messages.Message):
     name               = messages.StringField(1)
     email              = messages.StringField(2)
     websafeKey         = messages.StringField(3)
-    sessionKeysToSpeak = messages.StringField(4, repeated=True)
 
 class SpeakerForms(messages.Message):
     """SpeakerForms -- multiple  outbound form message"""
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextPageToken = messages.StringField(2)
 
 class SpeakerMiniForm(messages.Message):
     """SpeakerMiniForm -- update Speaker form message"""
     email = messages.StringField(1)
- 
\ No newline at end of file
+    name  = messages.StringField(2)
+ 
+
+class BulkJob(ndb.Model):
+    """BulkJob -- checkpoint of a bulk import or export task chain"""
+    operation     = ndb.StringProperty(required=True)   # import or export
+    kind          = ndb.StringProperty(required=True)
+    format        = ndb.StringProperty(default='jsonl')
+    path          = ndb.StringProperty(required=True, indexed=False)
+    status        = ndb.StringProperty(default='running')
+    step          = ndb.IntegerProperty(default=0, indexed=False)
+    count         = ndb.IntegerProperty(default=0, indexed=False)
+    # import: byte offset of the next line, and the CSV header
+    offset        = ndb.IntegerProperty(default=0, indexed=False)
+    columns       = ndb.StringProperty(repeated=True, indexed=False)
+    # import: keys chosen for the batch at pendingOffset, reused on retry
+    pendingOffset = ndb.IntegerProperty(indexed=False)
+    pendingKeys   = ndb.StringProperty(repeated=True, indexed=False)
+    # export: query cursor and number of part files written
+    cursor        = ndb.StringProperty(indexed=False)
+    part          = ndb.IntegerProperty(default=0, indexed=False)
+    error         = ndb.TextProperty()
+    created       = ndb.DateTimeProperty(auto_now_add=True)
+    updated       = ndb.DateTimeProperty(auto_now=True, indexed=False)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counters for conference registration.
+
+A Conference's available seats are spread over several SeatShard root
+entities so that registrations for a popular conference don't all
+serialize on the Conference entity group.  Conference.seatsAvailable is
+kept as a lagged roll-up of the shards for queries (announcements,
+seatsAvailable filters, list views).
+
+"""
+
+import random
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+# number of shards a conference's seats are split over; each shard is a
+# separate entity group so this bounds registration write throughput
+NUM_SEAT_SHARDS = 10
+
+# Conference.seatsAvailable is rolled up at most once per window
+ROLLUP_WINDOW_SECS = 10
+
+
+def shardKeys(conf):
+    """Return the SeatShard keys for conf."""
+    c_id = conf.key.urlsafe()
+    return [ndb.Key(SeatShard, '%s-%d' % (c_id, i))
+            for i in range(conf.seatShards)]
+
+
+@ndb.transactional(xg=True)
+def _createShards(c_key):
+    """Split the Conference's seatsAvailable over NUM_SEAT_SHARDS shards."""
+    conf = c_key.get()
+    if conf.seatShards:
+        return conf
+
+    seats = max(conf.seatsAvailable or 0, 0)
+    conf.seatShards = NUM_SEAT_SHARDS
+    shards = []
+    for i, sh_key in enumerate(shardKeys(conf)):
+        count = seats // NUM_SEAT_SHARDS
+        if i < seats % NUM_SEAT_SHARDS:
+            count += 1
+        shards.append(SeatShard(key=sh_key, seatsAvailable=count))
+    ndb.put_multi(shards + [conf])
+    return conf
+
+
+def ensureShards(conf):
+    """Return conf, creating its seat shards first if it has none."""
+    if conf.seatShards:
+        return conf
+    return _createShards(conf.key)
+
+
+def adjustShards(conf, delta):
+    """Add delta (possibly negative) seats across conf's shards, leaving
+    the registrations made since the last roll-up in place.
+
+    Seats are taken from the fullest shards first, and no shard goes
+    below zero.  Must be called inside a cross-group transaction on conf
+    that also puts it.  Returns the exact number of seats left.
+    """
+    keys = shardKeys(conf)
+    shards = [shard or SeatShard(key=sh_key)
+              for sh_key, shard in zip(keys, ndb.get_multi(keys))]
+    if delta > 0:
+        for i, shard in enumerate(shards):
+            shard.seatsAvailable += delta // len(shards)
+            if i < delta % len(shards):
+                shard.seatsAvailable += 1
+    else:
+        for shard in sorted(shards, key=lambda shard: -shard.seatsAvailable):
+            taken = min(shard.seatsAvailable, -delta)
+            shard.seatsAvailable -= taken
+            delta += taken
+    ndb.put_multi(shards)
+    return sum(shard.seatsAvailable for shard in shards)
+
+
+def shardsWithSeats(conf):
+    """Return shard keys that currently have seats, in random order."""
+    keys = shardKeys(conf)
+    shards = ndb.get_multi(keys)
+    keys = [sh_key for sh_key, shard in zip(keys, shards)
+            if shard and shard.seatsAvailable > 0]
+    random.shuffle(keys)
+    return keys
+
+
+def anyShard(conf):
+    """Return a random shard key, e.g. to give a seat back to."""
+    return random.choice(shardKeys(conf))
+
+
+def seatsAvailable(conf):
+    """Return the exact number of seats left, summed over the shards."""
+    if not conf.seatShards:
+        return conf.seatsAvailable
+    return sum(shard.seatsAvailable
+               for shard in ndb.get_multi(shardKeys(conf)) if shard)
+
+
+def seatsChanged(c_key):
+    """Schedule a roll-up of the shards into Conference.seatsAvailable.
+
+    Tasks are named per conference and time window, so a burst of
+    registrations causes a single roll-up.
+    """
+    window = int(time.time()) // ROLLUP_WINDOW_SECS
+    try:
+        taskqueue.add(name='seats-%s-%d' % (c_key.urlsafe(), window),
+            params={'conference_key': c_key.urlsafe()},
+            url='/tasks/rollup_seats',
+            countdown=ROLLUP_WINDOW_SECS)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def rollup(c_key):
+    """Write the summed shard counts back to Conference.seatsAvailable.
+
+    The shards are summed inside the transaction, so a registration
+    committing meanwhile makes it retry rather than write an old total.
+    Returns True if the Conference changed.
+    """
+    @ndb.transactional(xg=True)
+    def txn():
+        conf = c_key.get()
+        if not conf or not conf.seatShards:
+            return False
+        total = seatsAvailable(conf)
+        if conf.seatsAvailable != total:
+            conf.seatsAvailable = total
+            conf.put()
+            return True
+        return False
+    return txn()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""serializers.py
+
+Precompiled copy plans from ndb entities to ProtoRPC messages.
+
+Working out which message fields map to which entity properties, and how
+each value has to be converted, is done once per (model, message) pair
+when the plan is built.  Copying an entity is then a tight loop over the
+precomputed steps.
+
+"""
+
+import copy
+from operator import attrgetter
+
+from google.appengine.ext import ndb
+
+_plans = {}
+
+
+def websafeKey(entity):
+    """Computed field: the entity's websafe key."""
+    return entity.key.urlsafe()
+
+
+def websafeParentKey(entity):
+    """Computed field: the websafe key of the entity's parent."""
+    return entity.key.parent().urlsafe()
+
+
+class CopyPlan(object):
+    """Field-copy plan from ndb model instances to a ProtoRPC message."""
+
+    def __init__(self, model, message, converters=None, computed=None):
+        converters = converters or {}
+        computed = computed or {}
+        self.message = message
+        self.steps = []
+        for field in message.all_fields():
+            name = field.name
+            if name in computed:
+                self.steps.append((name, computed[name], None))
+            elif isinstance(getattr(model, name, None), ndb.Property):
+                self.steps.append((name, attrgetter(name),
+                                   converters.get(name)))
+        self.fieldNames = frozenset(field.name for field in message.all_fields())
+        # messages without required fields are always initialized
+        self.check = any(field.required for field in message.all_fields())
+        self._masked = {}
+
+    def only(self, fields):
+        """Return a plan copying just the named fields; all if fields is None."""
+        if fields is None:
+            return self
+        fields = frozenset(fields)
+        if fields not in self._masked:
+            masked = copy.copy(self)
+            masked.steps = [step for step in self.steps if step[0] in fields]
+            masked._masked = {}
+            self._masked[fields] = masked
+        return self._masked[fields]
+
+    def copy(self, entity, **overrides):
+        """Copy entity to a new message; non-None overrides win."""
+        msg = self.message()
+        for name, get, convert in self.steps:
+            value = get(entity)
+            if convert:
+                value = convert(value)
+            setattr(msg, name, value)
+        for name, value in overrides.iteritems():
+            if value is not None:
+                setattr(msg, name, value)
+        if self.check:
+            msg.check_initialized()
+        return msg
+
+    def copyAll(self, entities, **columns):
+        """Copy a list of entities to messages in one call.
+
+        Each keyword is a list of override values, one per entity.
+        """
+        if not columns:
+            return [self.copy(entity) for entity in entities]
+        names = columns.keys()
+        rows = zip(*[columns[name] for name in names])
+        return [self.copy(entity, **dict(zip(names, row)))
+                for entity, row in zip(entities, rows)]
+
+
+def plan(model, message, converters=None, computed=None):
+    """Return the CopyPlan for (model, message), building it once."""
+    key = (model, message)
+    if key not in _plans:
+        _plans[key] = CopyPlan(model, message, converters, computed)
+    return _plans[key]
@@ -10,9 +10,36 @@ created/forked from conference.py by wesc on 2014 may 24
 
 """
 
+import os
+
 # Replace the following lines with client IDs obtained from the APIs
 # Console or Cloud Console.
 WEB_CLIENT_ID = '747108802188-p47q44er9otfstugs5481hka3e750r8a.apps.googleusercontent.com'
 ANDROID_CLIENT_ID = 'replace with Android client ID'
 IOS_CLIENT_ID = 'replace with iOS client ID'
 ANDROID_AUDIENCE = WEB_CLIENT_ID
+
+# Audiences accepted on ID tokens verified locally.
+TOKEN_AUDIENCES = (WEB_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID)
+
+# How utils.getUserId identifies users: "email" (the default, which
+# existing Profiles are keyed by) or "oauth" to verify the request's
+# bearer token with tokens.py.
+USER_ID_TYPE = 'email'
+
+# Token verification services; point these at a local stand-in to test.
+TOKENINFO_URL = os.environ.get('TOKENINFO_URL',
+    'https://www.googleapis.com/oauth2/v1/tokeninfo')
+SIGNING_KEYS_URL = os.environ.get('SIGNING_KEYS_URL',
+    'https://www.googleapis.com/oauth2/v3/certs')
+
+# Log one structured line per request with its stats (see stats.py).
+STATS_LOG_REQUESTS = False
+
+# Request header naming the user on the development server only, so load
+# tests can run without OAuth tokens (see context.py and loadtest.py).
+# It is ignored unless ALLOW_STUB_AUTH is on; turn it on for a local run
+# with dev_appserver.py --env_var ALLOW_STUB_AUTH=1, never on a server
+# other machines can reach.
+STUB_AUTH_HEADER = 'X-Stub-User'
+ALLOW_STUB_AUTH = os.environ.get('ALLOW_STUB_AUTH') == '1'
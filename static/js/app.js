@@ -130,3 +130,36 @@ app.factory('oauth2Provider', function ($modal) {
 
     return oauth2Provider;
 });
+
+/**
+ * @ngdoc service
+ * @name conditionalGet
+ *
+ * @description
+ * Calls a versioned read of the conference API (getConference, getProfile, getConferenceSessions,
+ * getAnnouncement, getFeaturedSpeaker) with the version of the last response it got for the same
+ * parameters. When the server answers notModified, the callback gets that earlier response.
+ *
+ */
+app.factory('conditionalGet', function () {
+    var responses = {};
+
+    return function (method, params, callback) {
+        var key = method + ':' + angular.toJson(params);
+        var last = responses[key];
+        var request = angular.extend({}, params);
+        if (last) {
+            request.ifNoneMatch = last.result.version;
+        }
+        gapi.client.conference[method](request).execute(function (resp) {
+            if (!resp.error && resp.result) {
+                if (resp.result.notModified && last) {
+                    resp = last;
+                } else if (resp.result.version) {
+                    responses[key] = resp;
+                }
+            }
+            callback(resp);
+        });
+    };
+});
@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+
+"""stats.py
+
+Per-method call, latency, RPC and memcache hit instrumentation.
+
+instrument() wraps a WSGI application so that every request it serves
+(each ConferenceApi method and each main.py handler) is timed and has
+its API calls counted by service through apiproxy hooks.  Counts are
+summed in process and added to memcache counters every FLUSH_SECS, so
+the aggregates cost a couple of memcache calls per instance per flush
+rather than per request.  snapshot() reads them back for the admin-only
+/admin/stats handler.
+
+With settings.STATS_LOG_REQUESTS each request is also logged as one
+structured line.
+
+"""
+
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+import settings
+
+SERVICES = ('datastore_v3', 'memcache', 'taskqueue', 'urlfetch', 'mail')
+OTHER_SERVICE = 'other'
+METRICS = ('calls', 'errors', 'wallMs', 'memcacheKeys', 'memcacheHits',
+           'entitiesRead') + \
+    tuple('rpc.%s' % service for service in SERVICES + (OTHER_SERVICE,))
+FLUSH_SECS = 10
+MEMCACHE_STATS_KEY = 'STATS:%s:%s'
+MEMCACHE_STATS_METHODS_KEY = 'STATS:METHODS'
+SPI_PREFIX = '/_ah/spi/'
+
+_local = threading.local()
+_lock = threading.Lock()
+_pending = {}
+_lastFlush = [time.time()]
+
+
+def _count(counts, name, value):
+    counts[name] = counts.get(name, 0) + value
+
+
+def _preCall(service, call, request, response):
+    counts = getattr(_local, 'counts', None)
+    if counts is None:
+        return
+    if service not in SERVICES:
+        service = OTHER_SERVICE
+    _count(counts, 'rpc.%s' % service, 1)
+
+
+def _postCall(service, call, request, response, rpc=None, error=None):
+    counts = getattr(_local, 'counts', None)
+    if counts is None or error:
+        return
+    if service == 'memcache' and call == 'Get':
+        _count(counts, 'memcacheKeys', request.key_size())
+        _count(counts, 'memcacheHits', response.item_size())
+    elif service == 'datastore_v3' and call == 'Get':
+        _count(counts, 'entitiesRead',
+               sum(1 for entity in response.entity_list()
+                   if entity.has_entity()))
+    elif service == 'datastore_v3' and call in ('RunQuery', 'Next'):
+        _count(counts, 'entitiesRead', response.result_size())
+
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('stats', _preCall)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('stats', _postCall)
+
+
+def methodName(environ):
+    """Name requests by API method, or by path for plain handlers."""
+    path = environ.get('PATH_INFO', '')
+    if path.startswith(SPI_PREFIX):
+        return path[len(SPI_PREFIX):]
+    return path
+
+
+def _record(method, counts):
+    with _lock:
+        pending = _pending.setdefault(method, {})
+        for name, value in counts.iteritems():
+            pending[name] = pending.get(name, 0) + value
+        if time.time() - _lastFlush[0] < FLUSH_SECS:
+            return
+        _lastFlush[0] = time.time()
+        batch = dict(_pending)
+        _pending.clear()
+    flush(batch)
+
+
+def flush(batch):
+    """Add {method: {metric: delta}} to the memcache aggregates."""
+    deltas = {}
+    for method, counts in batch.iteritems():
+        for name, value in counts.iteritems():
+            if value:
+                deltas[MEMCACHE_STATS_KEY % (method, name)] = int(value)
+    if not deltas:
+        return
+    memcache.offset_multi(deltas, initial_value=0)
+    # the method index is best effort; a lost update only hides a method
+    # until its next flush
+    methods = memcache.get(MEMCACHE_STATS_METHODS_KEY) or []
+    missing = set(batch) - set(methods)
+    if missing:
+        memcache.set(MEMCACHE_STATS_METHODS_KEY, sorted(set(methods) | missing))
+
+
+def snapshot():
+    """Return {method: metrics} for every method recorded so far."""
+    methods = memcache.get(MEMCACHE_STATS_METHODS_KEY) or []
+    values = memcache.get_multi([MEMCACHE_STATS_KEY % (method, name)
+                                 for method in methods for name in METRICS])
+    result = {}
+    for method in methods:
+        metrics = dict((name, values.get(MEMCACHE_STATS_KEY % (method, name), 0))
+                       for name in METRICS)
+        if metrics['calls']:
+            metrics['avgWallMs'] = metrics['wallMs'] / float(metrics['calls'])
+        if metrics['memcacheKeys']:
+            metrics['memcacheHitRatio'] = \
+                metrics['memcacheHits'] / float(metrics['memcacheKeys'])
+        result[method] = metrics
+    return result
+
+
+def reset():
+    """Forget all aggregates."""
+    methods = memcache.get(MEMCACHE_STATS_METHODS_KEY) or []
+    memcache.delete_multi([MEMCACHE_STATS_KEY % (method, name)
+                           for method in methods for name in METRICS] +
+                          [MEMCACHE_STATS_METHODS_KEY])
+
+
+@contextmanager
+def collect():
+    """Count the API calls made inside the block into the yielded dict.
+
+    Blocks nest: an enclosing block's counts include the inner block's,
+    so benchmark.py sees the calls of the handlers it drives.
+    """
+    outer = getattr(_local, 'counts', None)
+    _local.counts = counts = {}
+    try:
+        yield counts
+    finally:
+        _local.counts = outer
+        if outer is not None:
+            for name, count in counts.iteritems():
+                outer[name] = outer.get(name, 0) + count
+
+
+def instrument(app):
+    """Wrap WSGI app so each request it serves is recorded."""
+    def instrumented(environ, start_response):
+        status = []
+
+        def recordStatus(code, headers, *args):
+            status.append(code)
+            return start_response(code, headers, *args)
+
+        start = time.time()
+        try:
+            with collect() as counts:
+                return app(environ, recordStatus)
+        finally:
+            counts['calls'] = 1
+            counts['wallMs'] = int((time.time() - start) * 1000)
+            if not status or status[0][:1] == '5':
+                counts['errors'] = 1
+            method = methodName(environ)
+            if getattr(settings, 'STATS_LOG_REQUESTS', False):
+                logging.info('stats %s', json.dumps(dict(counts, method=method),
+                                                    sort_keys=True))
+            _record(method, counts)
+    return instrumented
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+
+"""tokens.py
+
+OAuth token verification for utils.getUserId.
+
+Verifying a token used to cost a tokeninfo round trip on every request.
+Results are now cached by a hash of the token, in process and in
+memcache, for no longer than the token is valid.  Rejected tokens are
+remembered for a minute, so a client retrying a bad token doesn't cost a
+verification each time.  ID tokens (JWTs) are
+verified locally against Google's signing keys, which are cached the
+same way, so the tokeninfo service is only asked about access tokens and
+about ID tokens we cannot check ourselves.
+
+The tokeninfo and signing key URLs come from settings, so tests can
+point them at a local stand-in.
+
+"""
+
+import base64
+import hashlib
+import json
+import logging
+import re
+import threading
+import time
+import urllib
+from collections import OrderedDict
+
+from google.appengine.api import memcache
+from google.appengine.api import urlfetch
+
+import settings
+
+try:
+    from Crypto.Hash import SHA256
+    from Crypto.PublicKey import RSA
+    from Crypto.Signature import PKCS1_v1_5
+except ImportError:
+    # without pycrypto every token goes to the tokeninfo service
+    RSA = None
+
+MEMCACHE_TOKENINFO_KEY = 'TOKENINFO:%s'
+MEMCACHE_SIGNING_KEYS_KEY = 'SIGNING_KEYS'
+MEMCACHE_SIGNING_KEYS_REFRESH_KEY = 'SIGNING_KEYS_REFRESH'
+MAX_TOKENINFO_SECS = 3600
+# invalid tokens are remembered for this long
+INVALID_TOKEN_SECS = 60
+DEFAULT_SIGNING_KEYS_SECS = 3600
+# an unknown key id refetches the signing keys at most this often
+SIGNING_KEYS_REFRESH_SECS = 60
+CLOCK_SKEW_SECS = 300
+ID_TOKEN_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+
+
+class LRUCache(object):
+    """Small in-process cache of values that expire at a given time.
+
+    The app is threadsafe, so every access holds the cache's lock.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the live value for key, or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[0] <= time.time():
+                return None
+            self._entries[key] = entry
+            return entry[1]
+
+    def set(self, key, value, expires):
+        """Keep value for key until the unix time expires."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_tokens = LRUCache(1000)
+_signingKeys = LRUCache(1)
+
+
+def _tokenHash(token):
+    return hashlib.sha256(token).hexdigest()
+
+
+def _b64decode(data):
+    """Decode unpadded base64url."""
+    return base64.urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+
+def _b64int(data):
+    return long(_b64decode(data).encode('hex'), 16)
+
+
+def _maxAge(headers):
+    """Return the Cache-Control max-age of a response, or None."""
+    match = re.search(r'max-age=(\d+)', headers.get('cache-control', ''))
+    return int(match.group(1)) if match else None
+
+
+def _constructKeys(jwks):
+    return dict((key['kid'], RSA.construct((_b64int(key['n']),
+                                            _b64int(key['e']))))
+                for key in jwks.get('keys', []) if key.get('kty') == 'RSA')
+
+
+def signingKeys(refresh=False):
+    """Return Google's ID token signing keys as {kid: RSA key}.
+
+    The JWKS document is cached in memcache for as long as its
+    Cache-Control header allows, and the keys built from it in process.
+    """
+    keys = None if refresh else _signingKeys.get('keys')
+    if keys is not None:
+        return keys
+    jwks = None if refresh else memcache.get(MEMCACHE_SIGNING_KEYS_KEY)
+    ttl = DEFAULT_SIGNING_KEYS_SECS
+    if jwks is None:
+        resp = urlfetch.fetch(settings.SIGNING_KEYS_URL)
+        if resp.status_code != 200:
+            logging.warning('Fetching signing keys failed: %d',
+                            resp.status_code)
+            return {}
+        jwks = json.loads(resp.content)
+        ttl = _maxAge(resp.headers) or DEFAULT_SIGNING_KEYS_SECS
+        memcache.set(MEMCACHE_SIGNING_KEYS_KEY, jwks, time=ttl)
+    keys = _constructKeys(jwks)
+    _signingKeys.set('keys', keys, time.time() + ttl)
+    return keys
+
+
+def _mayRefreshSigningKeys():
+    """True at most once per SIGNING_KEYS_REFRESH_SECS across instances,
+    so tokens with made-up key ids can't make every request refetch.
+    """
+    return memcache.add(MEMCACHE_SIGNING_KEYS_REFRESH_KEY, 1,
+                        time=SIGNING_KEYS_REFRESH_SECS)
+
+
+def verifyIdToken(token, audiences=None):
+    """Verify an RS256 ID token locally, returning its claims or None.
+
+    Checks the signature against the cached signing keys (fetching them
+    again for an unknown key id, at most once a minute), the issuer, the
+    expiry and, if given, that the audience is one of audiences.
+    """
+    if RSA is None:
+        return None
+    try:
+        header, payload, signature = token.split('.')
+        head = json.loads(_b64decode(header))
+        claims = json.loads(_b64decode(payload))
+        signature = _b64decode(signature)
+    except (ValueError, TypeError):
+        return None
+    if head.get('alg') != 'RS256':
+        return None
+
+    keys = signingKeys()
+    if head.get('kid') not in keys and _mayRefreshSigningKeys():
+        keys = signingKeys(refresh=True)
+    key = keys.get(head.get('kid'))
+    if key is None:
+        return None
+    digest = SHA256.new('%s.%s' % (header, payload))
+    if not PKCS1_v1_5.new(key).verify(digest, signature):
+        return None
+
+    now = time.time()
+    if claims.get('iss') not in ID_TOKEN_ISSUERS:
+        return None
+    if not claims.get('exp') or claims['exp'] + CLOCK_SKEW_SECS < now:
+        return None
+    if audiences and claims.get('aud') not in audiences:
+        return None
+    return claims
+
+
+def _fetchTokenInfo(token, token_type):
+    """Ask the tokeninfo service about token, returning its info, False
+    if it rejected the token, or None if it couldn't say.
+
+    An ID token it rejects is tried once more as an access token.
+    """
+    url = '%s?%s' % (settings.TOKENINFO_URL,
+                     urllib.urlencode({token_type: token}))
+    resp = urlfetch.fetch(url)
+    if resp.status_code == 200:
+        return json.loads(resp.content)
+    if resp.status_code == 400 and 'invalid_token' in resp.content:
+        if token_type != 'access_token':
+            return _fetchTokenInfo(token, 'access_token')
+        return False
+    logging.warning('tokeninfo returned %d', resp.status_code)
+    return None
+
+
+def tokenInfo(token, token_type='id_token'):
+    """Return {'user_id', 'email', 'exp'} for a valid token, else None.
+
+    Valid results are cached by token hash until the token expires, for
+    at most MAX_TOKENINFO_SECS.  Tokens that fail verification, including
+    ID tokens with an unknown key id, are cached as False for
+    INVALID_TOKEN_SECS.
+    """
+    key = _tokenHash(token)
+    info = _tokens.get(key)
+    if info is not None:
+        return info or None
+    info = memcache.get(MEMCACHE_TOKENINFO_KEY % key)
+    if info is False:
+        _tokens.set(key, False, time.time() + INVALID_TOKEN_SECS)
+        return None
+    if info is not None and info['exp'] > time.time():
+        _tokens.set(key, info, info['exp'])
+        return info
+
+    info = None
+    if token_type == 'id_token' and token.count('.') == 2:
+        claims = verifyIdToken(token, settings.TOKEN_AUDIENCES)
+        if claims:
+            info = {'user_id': claims.get('sub', ''),
+                    'email': claims.get('email'),
+                    'exp': claims['exp']}
+    if info is None:
+        fetched = _fetchTokenInfo(token, token_type)
+        if fetched is False:
+            memcache.set(MEMCACHE_TOKENINFO_KEY % key, False,
+                         time=INVALID_TOKEN_SECS)
+            _tokens.set(key, False, time.time() + INVALID_TOKEN_SECS)
+        elif fetched:
+            info = {'user_id': fetched.get('user_id', ''),
+                    'email': fetched.get('email'),
+                    'exp': time.time() + int(fetched.get('expires_in', 0))}
+    if info is None:
+        return None
+
+    expires = min(info['exp'], time.time() + MAX_TOKENINFO_SECS)
+    ttl = int(expires - time.time())
+    if ttl > 0:
+        memcache.set(MEMCACHE_TOKENINFO_KEY % key, info, time=ttl)
+        _tokens.set(key, info, expires)
+    return info